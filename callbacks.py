@@ -352,6 +352,72 @@ def saveModel(model, model_name, epoch, fold_num, save_model_dir):
     model.save(save_model_epoch_dir + 'savedModel')
 
 
+def saveTFLiteModel(model, model_name, fold_num, representative_dataset, num_calibration_batches, preprocessing, strategy, save_model_dir):
+    """
+    converts a trained model to TensorFlow Lite with post-training int8 quantization and saves it
+    activation ranges are calibrated on the first batches of a representative dataset
+    works only for models with a single input
+
+    parameters
+    ----------
+        model : object
+            trained model
+
+        model_name : string
+            model name
+
+        fold_num : integer
+            training fold number
+
+        representative_dataset : strategy.experimental_distribute_dataset object
+            distributed dataset of (data, labels), only data of the first GPU is used
+
+        num_calibration_batches : integer
+            number of batches to calibrate activation ranges on
+
+        preprocessing : function
+            normalization applied to data before it is passed to the model
+            None if data is already preprocessed in the tf.data pipeline
+
+        strategy : tf.distribute object
+            TensorFlow API used in distributed training
+
+        save_model_dir : string
+            directory where to save the model
+    """
+
+    if fold_num is not None:
+        save_model_fold_dir = save_model_dir + \
+            model_name + '/' + 'fold-' + str(fold_num + 1) + '/'
+    else:
+        save_model_fold_dir = save_model_dir + \
+            model_name + '/' + 'no-folds/'
+
+    if not os.path.exists(save_model_fold_dir):
+        os.makedirs(save_model_fold_dir)
+
+    def representativeData():
+
+        for num_batch, batch in enumerate(representative_dataset):
+
+            if num_batch == num_calibration_batches:
+                break
+
+            data = strategy.experimental_local_results(batch[0])[0]
+            if preprocessing is not None:
+                data = preprocessing(data)
+
+            for sample in data:
+                yield [tf.expand_dims(tf.cast(sample, tf.float32), 0)]
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representativeData
+
+    with open(save_model_fold_dir + model_name + '_int8.tflite', 'wb') as tflite_file:
+        tflite_file.write(converter.convert())
+
+
 def saveTrainInfoDetection(model_name, epoch, loc_loss, class_loss, total_loss, optimizer, save_csv_dir):
     """
     saves current training information of an object detection model in a dataframe
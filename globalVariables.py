@@ -1,7 +1,11 @@
+import functools
+
 import numpy as np
 import pandas as pd
 import albumentations as A
 
+from permutationFunctions import FusedColorGeom, RandomGammaLUT
+
 
 # classification
 NUM_EPOCHS = 35
@@ -40,6 +44,18 @@ BATCH_SIZES = {
     'cait_xxs24_384': 48,
     'convnext_base_384_in22ft1k': 32,
     'resnetv2_50x1_bitm_in21k': 48}
+# every model runs on the same physical batch per GPU, so the compiled train step has the same shapes for all of them
+# BATCH_SIZES is reached by accumulating gradients over GRAD_ACCUM_STEPS micro-batches before every optimizer update
+# steps are rounded up, so the effective batch per GPU is PHYSICAL_BATCH_SIZE * GRAD_ACCUM_STEPS,
+# which is larger than BATCH_SIZES if they are not divisible by PHYSICAL_BATCH_SIZE
+PHYSICAL_BATCH_SIZE = 4
+GRAD_ACCUM_STEPS = {name: int(np.ceil(batch_size / PHYSICAL_BATCH_SIZE)) for name, batch_size in BATCH_SIZES.items()}
+# instead of PHYSICAL_BATCH_SIZE, probe every model once for the largest batch per GPU that fits into memory
+# BATCH_SIZES is still reached with gradient accumulation, but compiled shapes then differ between models
+AUTO_BATCH_SIZE = False
+BATCH_SIZE_MIN = 4
+BATCH_SIZE_MULT = 4
+BATCH_MEMORY_FRACTION = 0.95
     
 INPUT_SHAPE = (224, 448, 3)
 
@@ -66,12 +82,15 @@ ARC_DENSE = 1024
 DO_PREDICTIONS = False
 OUTPUT_ACTIVATION = 'sigmoid' # 'sigmoid', 'softmax', 'relu', None
 NUM_CLASSES = 22 # 152
+SAMPLED_SOFTMAX = False # train with sampled softmax over NUM_SAMPLED classes, full softmax is only run for training metrics
+NUM_SAMPLED = 1024
 NUM_ADD_CLASSES = None
 
 UNFREEZE = True
 UNFREEZE_FULL = True
 UNFREEZE_PERCENT = None # 25
 UNFREEZE_BATCHNORM = False
+EXTRACT_FEATURES = True # if UNFREEZE = False, run the frozen ImageNet body once per run and train only head layers on its outputs, data permutations are not applied
 NUM_UNFREEZE_LAYERS = {
     'VGG16': None,
     'VGG19': None,
@@ -107,6 +126,20 @@ VAL_FILEPATHS = 'projects/birdclef-2022/data/val_22_less15/' # 'projects/birdcle
 DO_VALIDATION = True
 VAL_SPLIT = 0.25
 MAX_FILES_PER_PART = 2000
+DATA_FORMAT = 'numpy' # 'numpy', 'tfrecord', 'memmap'
+UINT8_PIPELINE = True # keep data uint8 in tf.data, permute and normalize it on GPU inside the training step
+NUM_CPU_THREADS = None # inter-op threads for tf.data workers and numpy_function permutations, None - all cores
+DEVICE_PREFETCH_BUFFER = 2 # batches prefetched into every GPU's memory
+# cache parsed TFRecords or decoded .npy files after the first epoch: None - off, '' - in memory, path - on disk
+# cached training data is reshuffled every epoch in a buffer of SHUFFLE_BUFFER_SIZE samples
+CACHE_DIR = None
+SHUFFLE_BUFFER_SIZE = None # training samples held in the shuffle buffer of cached data and TFRecords, None - the whole training split
+MIXED_PRECISION_POLICY = 'auto' # 'mixed_bfloat16', 'mixed_float16', 'auto' (bfloat16 on Ampere and newer, float16 otherwise), None
+JIT_COMPILE = True # compile forward/backward passes with XLA, compiled once per model and reused by all its folds
+CROSS_DEVICE_OPS = 'auto' # 'nccl', 'hierarchical', 'reduce', 'auto'
+COOLDOWN_SECONDS = 0 # pause between models, only needed on hardware that throttles
+TFRECORDS_DIR = 'projects/birdclef-2022/data/tfrecords/'
+MEMMAP_DIR = 'projects/birdclef-2022/data/memmap/'
 RANDOM_STATE = 1337
 
 METADATA = None
@@ -115,7 +148,7 @@ TARGET_FEATURE_COLUMNS = ['label_idx']
 ADD_FEATURES_COLUMNS = None
 FILENAME_UNDERSCORE = False
 CREATE_ONEHOT = True
-CREATE_SPARSE = False
+CREATE_SPARSE = False # int64 class indices with SparseCategoricalCrossentropy and sparse metrics, needs OUTPUT_ACTIVATION = 'softmax'
 LABEL_IDX = 2
 LABEL_IDXS_ADD = None
 
@@ -127,6 +160,8 @@ CLASSIFICATION_CHECKPOINT_PATH = 'projects/birdclef-2022/training/weights/Effici
 
 SAVE_TRAIN_INFO_DIR = 'projects/birdclef-2022/training/info/'
 SAVE_TRAIN_WEIGHTS_DIR = 'projects/birdclef-2022/training/weights/'
+EXPORT_TFLITE = False # after training, save an int8 post-training quantized TensorFlow Lite model next to the weights
+NUM_CALIBRATION_BATCHES = 10 # batches of validation (or training) data used to calibrate int8 activation ranges
 
 # object detection
 MODEL_NAME_DETECTION = 'effdet0'
@@ -147,14 +182,27 @@ BBOX_FORMAT = 'albumentations'
 CHECKPOINT_PATH = 'object_detection/models/research/object_detection/test_data/checkpoint_efficientdet_d0/ckpt-0'  # change only /checkpoint_.../
 CONFIG_PATH = 'object_detection/models/research/object_detection/configs/tf2/ssd_efficientdet_d0_512x512_coco17_tpu-8.config'
 TRAIN_FILEPATHS_DETECTION = 'projects/testing_detection/datasets/train/'
-TRAIN_META_DETECTION = pd.read_csv(
-    'projects/testing_detection/datasets/metas/train_meta.csv')
+TRAIN_META_DETECTION_PATH = 'projects/testing_detection/datasets/metas/train_meta.csv'
 TEST_FILEPATHS_DETECTION = 'projects/testing_detection/datasets/test/'
-TEST_META_DETECTION = pd.read_csv(
-    'projects/testing_detection/datasets/metas/test_meta.csv')
+TEST_META_DETECTION_PATH = 'projects/testing_detection/datasets/metas/test_meta.csv'
+META_DETECTION_COLUMNS = ['filename', 'bboxes']
 SAVE_CHECKPOINT_DIR = 'projects/testing_detection/training/weights/'
 SAVE_TRAIN_INFO_DIR_DETECTION = 'projects/testing_detection/training/csvs/'
 
+
+# metadata is read on first use only, so importing this file doesn't touch the disk
+@functools.lru_cache(maxsize=None)
+def getTrainMetaDetection():
+    return pd.read_csv(
+        TRAIN_META_DETECTION_PATH, engine='c', usecols=META_DETECTION_COLUMNS, dtype=str)
+
+
+@functools.lru_cache(maxsize=None)
+def getTestMetaDetection():
+    return pd.read_csv(
+        TEST_META_DETECTION_PATH, engine='c', usecols=META_DETECTION_COLUMNS, dtype=str)
+
+
 # layers
 ARCMARGIN_S = 30
 ARCMARGIN_M = 0.3
@@ -252,22 +300,24 @@ VALUE_LIMIT = 0
 
 DO_PERMUTATIONS = False
 PERMUTATION_PROBABILITY_CLASSIFICATION = 1 / 12
-PERMUTATIONS_CLASSIFICATION = [
-    A.RandomGamma(gamma_limit=GAMMA_LIMIT,
-                  p=PERMUTATION_PROBABILITY_CLASSIFICATION),
-    A.HorizontalFlip(p=PERMUTATION_PROBABILITY_CLASSIFICATION),
-    # A.GaussianBlur(blur_limit=GAUSSIAN_BLUR_LIMIT,
-    #             p=PERMUTATION_PROBABILITY_CLASSIFICATION),
-    A.GlassBlur(max_delta=GLASS_BLUR_MAXDELTA, iterations=GLASS_BLUR_ITERATIONS,
-                p=PERMUTATION_PROBABILITY_CLASSIFICATION),
-    A.Sharpen(alpha=SHARPEN_ALPHA, lightness=SHARPEN_LIGHTNESS,
-            p=PERMUTATION_PROBABILITY_CLASSIFICATION),
-    A.Emboss(strength=EMBOSS_STRENGTH,
-            p=PERMUTATION_PROBABILITY_CLASSIFICATION),
-    A.RandomBrightnessContrast(brightness_limit=BRIGHTNESS_LIMIT, 
-        contrast_limit=CONTRAST_LIMIT, p=PERMUTATION_PROBABILITY_CLASSIFICATION),
-    A.HueSaturationValue(hue_shift_limit=HUE_LIMIT, sat_shift_limit=SATURATION_LIMIT, 
-        val_shift_limit=VALUE_LIMIT, p=PERMUTATION_PROBABILITY_CLASSIFICATION)]
+FUSE_PERMUTATIONS = False # fire colour permutations and flip independently in a single pass (FusedColorGeom, no blur)
+if FUSE_PERMUTATIONS:
+    PERMUTATIONS_CLASSIFICATION = FusedColorGeom(
+        gamma_limit=GAMMA_LIMIT, sharpen_alpha=SHARPEN_ALPHA, sharpen_lightness=SHARPEN_LIGHTNESS, 
+        emboss_strength=EMBOSS_STRENGTH, brightness_limit=BRIGHTNESS_LIMIT, contrast_limit=CONTRAST_LIMIT, 
+        sat_shift_limit=SATURATION_LIMIT, p=PERMUTATION_PROBABILITY_CLASSIFICATION)
+else:
+    # at most one permutation per image, so every image is read and written once
+    PERMUTATIONS_CLASSIFICATION = A.OneOf([
+        RandomGammaLUT(gamma_limit=GAMMA_LIMIT, p=1),
+        A.HorizontalFlip(p=1),
+        A.Sharpen(alpha=SHARPEN_ALPHA, lightness=SHARPEN_LIGHTNESS, p=1),
+        A.Emboss(strength=EMBOSS_STRENGTH, p=1),
+        A.RandomBrightnessContrast(brightness_limit=BRIGHTNESS_LIMIT, contrast_limit=CONTRAST_LIMIT, p=1),
+        A.HueSaturationValue(hue_shift_limit=HUE_LIMIT, sat_shift_limit=SATURATION_LIMIT, 
+            val_shift_limit=VALUE_LIMIT, p=1),
+        A.GlassBlur(max_delta=GLASS_BLUR_MAXDELTA, iterations=GLASS_BLUR_ITERATIONS, p=1)],
+        p=min(1, 7 * PERMUTATION_PROBABILITY_CLASSIFICATION))
     # A.Downscale(scale_min=DOWNSCALE_MIN, scale_max=DOWNSCALE_MIN,
     #             p=PERMUTATION_PROBABILITY_CLASSIFICATION),
     # A.GridDistortion(p=PERMUTATION_PROBABILITY_CLASSIFICATION),
@@ -275,12 +325,39 @@ PERMUTATIONS_CLASSIFICATION = [
     #                     shift_limit=OPTICAL_SHIFT_LIMIT, p=PERMUTATION_PROBABILITY_CLASSIFICATION),
     # A.Rotate(limit=ROTATE_LIMIT, p=PERMUTATION_PROBABILITY_CLASSIFICATION)]
 
+# batched permutations applied to whole batches inside the tf.data graph
+# glass blur is approximated with a fixed Gaussian kernel of the same reach, which changes the augmentation:
+# images are smoothed instead of having pixels locally scrambled, the CPU pipeline above keeps A.GlassBlur
+DO_PERMUTATIONS_GPU = True
+
+
+# permutation layers are built on first use only, so importing this file doesn't import TensorFlow
+@functools.lru_cache(maxsize=None)
+def getPermutationsClassificationGPU():
+
+    import tensorflow as tf
+    from layers import (
+        RandomHorizontalFlip, RandomGamma, RandomGaussianBlur, RandomSharpen, RandomEmboss,
+        RandomBrightnessContrast, RandomSaturation)
+
+    return tf.keras.Sequential([
+        RandomGamma(gamma_limit=GAMMA_LIMIT, p=PERMUTATION_PROBABILITY_CLASSIFICATION),
+        RandomHorizontalFlip(p=PERMUTATION_PROBABILITY_CLASSIFICATION),
+        RandomGaussianBlur(kernel_size=2 * GLASS_BLUR_MAXDELTA + 1, p=PERMUTATION_PROBABILITY_CLASSIFICATION),
+        RandomSharpen(alpha=SHARPEN_ALPHA, lightness=SHARPEN_LIGHTNESS, p=PERMUTATION_PROBABILITY_CLASSIFICATION),
+        RandomEmboss(strength=EMBOSS_STRENGTH, p=PERMUTATION_PROBABILITY_CLASSIFICATION),
+        RandomBrightnessContrast(
+            brightness_limit=BRIGHTNESS_LIMIT, contrast_limit=CONTRAST_LIMIT, p=PERMUTATION_PROBABILITY_CLASSIFICATION),
+        RandomSaturation(sat_shift_limit=SATURATION_LIMIT, p=PERMUTATION_PROBABILITY_CLASSIFICATION)],
+        name='permutations_classification')
+
+
 PERMUTATION_PROBABILITY_DETECTION = 1 / 4
 PERMUTATIONS_DETECTION = [
     A.HorizontalFlip(p=PERMUTATION_PROBABILITY_DETECTION),
     A.GaussianBlur(blur_limit=GAUSSIAN_BLUR_LIMIT,
                    p=PERMUTATION_PROBABILITY_DETECTION),
-    A.RandomGamma(gamma_limit=GAMMA_LIMIT, p=PERMUTATION_PROBABILITY_DETECTION)]
+    RandomGammaLUT(gamma_limit=GAMMA_LIMIT, p=PERMUTATION_PROBABILITY_DETECTION)]
 # A.Rotate(limit=ROTATE_LIMIT, p=PERMUTATION_PROBABILITY_DETECTION),
 
 # preprocessData
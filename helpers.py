@@ -1,5 +1,7 @@
 import os
+import re
 import gzip
+import subprocess
 import png
 import ast
 import shutil
@@ -10,8 +12,6 @@ from matplotlib.patches import Rectangle
 from PIL import Image
 from sklearn.model_selection import train_test_split
 
-from object_detection.utils import visualization_utils as viz_utils
-
 from globalVariables import VAL_SPLIT
 
 
@@ -35,6 +35,42 @@ def loadNumpy(path):
     return numpy_file
 
 
+def getNumpyHeader(path):
+    """
+    reads the header of a .npy file
+    used to decode raw bytes of files that share dtype and shape without parsing every header
+
+    parameters
+    ----------
+        path : string
+            full path to file
+
+    returns
+    -------
+        header_length : integer
+            number of bytes before the array data
+
+        dtype : numpy dtype
+            data type of the array
+
+        shape : tuple
+            shape of the array
+    """
+
+    with open(path, 'rb') as numpy_file:
+        version = np.lib.format.read_magic(numpy_file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(numpy_file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(numpy_file)
+        header_length = numpy_file.tell()
+
+    if fortran_order:
+        raise ValueError('Fortran ordered arrays are not supported: ' + path)
+
+    return header_length, dtype, shape
+
+
 def loadImage(path, image_type):
     """
     loads input image as numpy array
@@ -205,6 +241,9 @@ def visualizeDetections(image, boxes, classes, scores, category_index, score_thr
             minimum score threshold for a box or keypoint to be visualized
     """
 
+    # object detection API imports TensorFlow, so it's only imported when detections are visualized
+    from object_detection.utils import visualization_utils as viz_utils
+
     image_annotations = image.copy()
 
     viz_utils.visualize_boxes_and_labels_on_image_array(
@@ -477,3 +516,138 @@ def createSparseValue(path, right_class_idx):
     class_idx = int(class_idx)
 
     return class_idx
+
+
+def createSparseValueTensor(path, right_class_idx):
+    """
+    tensor counterpart of createSparseValue, parses a class index from a path inside a tf.data pipeline
+
+    parameters
+    -----------
+        path : tensor
+            string scalar, full path to a file
+
+        right_class_idx : int
+            which idx to use when splitting path my underscore
+
+    returns
+    -------
+        class_idx : tensor
+            int64 scalar, class index
+    """
+
+    # TensorFlow is imported only by helpers that use it, so importing this file doesn't import TensorFlow
+    import tensorflow as tf
+
+    class_string = tf.strings.split(path, '_')[-right_class_idx]
+    class_string = tf.strings.regex_replace(class_string, r'\.npy$', '')
+
+    return tf.strings.to_number(class_string, out_type=tf.int64)
+
+
+def getCrossDeviceOps(cross_device_ops):
+    """
+    returns cross device ops for tf.distribute.MirroredStrategy
+    NCCL all-reduce runs GPU to GPU and uses NVLink when it exists,
+    hierarchical copy stages gradients through host memory and is only preferable when GPUs share just PCIe
+    NCCL packs all gradients into a single all-reduce, so small gradient tensors don't cost a call each
+    TensorFlow builds without NCCL (Windows) reduce to one device instead
+
+    parameters
+    ----------
+        cross_device_ops : string
+            either 'nccl', 'hierarchical', 'reduce' or 'auto'
+            'auto' reads GPU topology from nvidia-smi and uses hierarchical copy only if no NVLink is found,
+            if the topology can't be read, NCCL is used
+
+    returns
+    -------
+        cross_device_ops : tf.distribute.CrossDeviceOps
+            all-reduce implementation
+            None (strategy default) if there are less than two GPUs, e.g. single GPU or CPU debugging
+    """
+
+    import tensorflow as tf
+
+    if len(tf.config.list_physical_devices('GPU')) < 2:
+        return None
+
+    if cross_device_ops == 'auto':
+
+        try:
+            topology = subprocess.run(
+                ['nvidia-smi', 'topo', '-m'], capture_output=True, text=True, timeout=10, check=True).stdout
+            gpu_rows = [row for row in topology.splitlines() if re.match(r'^\s*GPU\d+\s', row)]
+
+            if gpu_rows and not any(re.search(r'\bNV\d+\b', row) for row in gpu_rows):
+                cross_device_ops = 'hierarchical'
+            else:
+                cross_device_ops = 'nccl'
+
+        except (OSError, subprocess.SubprocessError):
+            cross_device_ops = 'nccl'
+
+    if cross_device_ops == 'hierarchical':
+        return tf.distribute.HierarchicalCopyAllReduce()
+
+    if (cross_device_ops == 'reduce') or (os.name == 'nt'):
+        return tf.distribute.ReductionToOneDevice()
+
+    return tf.distribute.NcclAllReduce(num_packs=1)
+
+
+def getMixedPrecisionPolicy(mixed_precision_policy):
+    """
+    returns mixed precision policy for tf.keras.mixed_precision.set_global_policy
+    bfloat16 needs no loss scaling, but only GPUs with compute capability 8.0 and higher (Ampere, Hopper) run it on Tensor Cores
+
+    parameters
+    ----------
+        mixed_precision_policy : string
+            either 'mixed_bfloat16', 'mixed_float16', 'auto' or None
+            'auto' picks 'mixed_bfloat16' if every GPU supports it, 'mixed_float16' otherwise and None without GPUs
+
+    returns
+    -------
+        mixed_precision_policy : string
+            name of the policy or None to train in float32
+    """
+
+    import tensorflow as tf
+
+    if mixed_precision_policy != 'auto':
+        return mixed_precision_policy
+
+    gpus = tf.config.list_physical_devices('GPU')
+
+    if not gpus:
+        return None
+
+    compute_capabilities = [tf.config.experimental.get_device_details(gpu).get('compute_capability', (0, 0)) for gpu in gpus]
+
+    if min(compute_capabilities) >= (8, 0):
+        return 'mixed_bfloat16'
+
+    return 'mixed_float16'
+
+
+def getGPUMemoryTotal():
+    """
+    returns memory of the smallest GPU, read from nvidia-smi
+
+    returns
+    -------
+        memory_total : integer
+            memory in bytes, None if nvidia-smi can't be read
+    """
+
+    try:
+        memory_total = subprocess.run(
+            ['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits'], 
+            capture_output=True, text=True, timeout=10, check=True).stdout
+        memory_total = min(int(row) for row in memory_total.split()) * 1024 * 1024
+
+    except (OSError, subprocess.SubprocessError, ValueError):
+        memory_total = None
+
+    return memory_total
@@ -1,5 +1,6 @@
 import math
 
+import numpy as np
 import tensorflow as tf
 
 
@@ -75,26 +76,329 @@ class ArcMarginProduct(tf.keras.layers.Layer):
         return output
 
 
+class MultiGlobalAveragePooling(tf.keras.layers.Layer):
+    '''
+    Global average pooling of several feature maps concatenated into one vector.
+
+    All reductions and the concatenation are a single layer, so that they are
+    traced (and compiled with XLA) together instead of as separate pooling
+    layers followed by a Concatenate layer.
+    '''
+    def call(self, inputs):
+        return tf.concat([tf.reduce_mean(x, axis=[1, 2]) for x in inputs], axis=-1)
+
+
 def unfreezeLayers(
     num_model_layers, 
     unfreeze_full, unfreeze_percent, num_unfreeze_layers, 
     model_name):
+    """
+    returns how many top layers of a model to unfreeze
+
+    parameters
+    ----------
+        num_model_layers : int
+            number of layers in the model, len(model.layers)
+
+        unfreeze_full : boolean
+            unfreeze every layer of the model
+
+        unfreeze_percent : int
+            percent of top layers to unfreeze, used if unfreeze_full = False
+
+        num_unfreeze_layers : dict
+            number of top layers to unfreeze for every model, used if unfreeze_full = False and unfreeze_percent = None
+            models that are missing or set to None are unfrozen fully
+
+        model_name : string
+            name of the model
+
+    returns
+    -------
+        to_unfreeze : int
+            number of top layers to unfreeze
+    """
 
     if unfreeze_full:
+
         to_unfreeze = num_model_layers
 
-    if unfreeze_percent is not None:
-        unfreeze_layers = unfreeze_percent / 100
-        to_unfreeze = num_model_layers[:-unfreeze_layers]
+    elif unfreeze_percent is not None:
+
+        to_unfreeze = (num_model_layers * unfreeze_percent) // 100
 
     else:
-        
-        if ((model_name == 'VGG16') or (model_name == 'VGG19')):
 
-            to_unfreeze = num_model_layers
+        to_unfreeze = num_unfreeze_layers.get(model_name)
 
-        else:
+        if to_unfreeze is None:
 
-            to_unfreeze = num_unfreeze_layers[model_name]
+            to_unfreeze = num_model_layers
 
     return to_unfreeze
+
+
+def depthwiseFilter(x, kernel):
+    """
+    convolves every channel of a batch of images with the same 2D kernel
+    borders are reflected so that the output has the same shape as the input
+
+    parameters
+    ----------
+        x : tensor
+            batch of images of shape (batch, height, width, channels)
+
+        kernel : ndarray or list
+            square 2D kernel of odd size
+
+    returns
+    -------
+        x_filtered : tensor
+            filtered batch of images
+    """
+
+    kernel = tf.constant(kernel, dtype=x.dtype)
+    kernel_size = kernel.shape[0]
+    pad = kernel_size // 2
+
+    kernel = tf.tile(kernel[:, :, tf.newaxis, tf.newaxis], [1, 1, x.shape[-1], 1])
+    x_padded = tf.pad(x, [[0, 0], [pad, pad], [pad, pad], [0, 0]], mode='REFLECT')
+
+    x_filtered = tf.nn.depthwise_conv2d(x_padded, kernel, strides=[1, 1, 1, 1], padding='VALID')
+
+    return x_filtered
+
+
+class RandomPermutation(tf.keras.layers.Layer):
+    '''
+    Base class for batched image permutations.
+
+    Every image of a batch is permuted independently with probability p,
+    so that the whole batch is processed with a single set of TensorFlow ops
+    instead of a Python call per image. Images are expected in [0, max_value].
+    Permutations are only applied when the layer is called with training=True.
+
+    The class is abstract: subclasses implement permute(inputs), which
+    returns the permuted float32 batch, and the base class can't be built.
+    '''
+    def __init__(self, p=0.5, max_value=255.0, **kwargs):
+
+        # checked when the layer is built, not on its first training call inside a traced step
+        if type(self).permute is RandomPermutation.permute:
+            raise TypeError(type(self).__name__ + ' has to implement permute(inputs)')
+
+        super(RandomPermutation, self).__init__(**kwargs)
+
+        self.p = p
+        self.max_value = max_value
+
+    def get_config(self):
+
+        config = super().get_config().copy()
+        config.update({
+            'p': self.p,
+            'max_value': self.max_value,
+        })
+        return config
+
+    def sampleUniform(self, inputs, minval, maxval):
+        batch_size = tf.shape(inputs)[0]
+        return tf.random.uniform(
+            [batch_size, 1, 1, 1], minval=minval, maxval=maxval, dtype=inputs.dtype)
+
+    def permute(self, inputs):
+        raise NotImplementedError(type(self).__name__ + ' has to implement permute(inputs)')
+
+    def call(self, inputs, training=None):
+        inputs = tf.cast(inputs, tf.float32)
+        if not training:
+            return inputs
+        permuted = self.permute(inputs)
+        apply = self.sampleUniform(inputs, 0.0, 1.0) < self.p
+        return tf.where(apply, permuted, inputs)
+
+
+class RandomHorizontalFlip(RandomPermutation):
+    '''
+    Flips images horizontally.
+    '''
+    def permute(self, inputs):
+        return tf.reverse(inputs, axis=[2])
+
+
+class RandomGamma(RandomPermutation):
+    '''
+    Batched counterpart of albumentations.RandomGamma.
+    '''
+    def __init__(self, gamma_limit=(80, 120), **kwargs):
+
+        super(RandomGamma, self).__init__(**kwargs)
+
+        self.gamma_limit = gamma_limit
+
+    def get_config(self):
+
+        config = super().get_config().copy()
+        config.update({'gamma_limit': self.gamma_limit})
+        return config
+
+    def permute(self, inputs):
+        gamma = self.sampleUniform(inputs, self.gamma_limit[0] / 100, self.gamma_limit[1] / 100)
+        x = tf.clip_by_value(inputs / self.max_value, 0.0, 1.0)
+        return tf.pow(x, gamma) * self.max_value
+
+
+class RandomGaussianBlur(RandomPermutation):
+    '''
+    Blurs images with a fixed Gaussian kernel.
+
+    Used as a batched stand-in for albumentations.GlassBlur, which shuffles
+    pixels in random local windows and can't be expressed as a convolution.
+    A Gaussian kernel of the same reach blurs comparably, but the
+    augmentation differs: images are smoothed instead of locally scrambled.
+    '''
+    def __init__(self, kernel_size=5, sigma=None, **kwargs):
+
+        super(RandomGaussianBlur, self).__init__(**kwargs)
+
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+
+        if sigma is None:
+            # same default as cv2.getGaussianKernel
+            sigma = 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+
+        ax = np.arange(kernel_size, dtype=np.float32) - (kernel_size - 1) / 2
+        gauss = np.exp(-(ax ** 2) / (2 * sigma ** 2))
+        gauss /= gauss.sum()
+        self.kernel = np.outer(gauss, gauss)
+
+    def get_config(self):
+
+        config = super().get_config().copy()
+        config.update({
+            'kernel_size': self.kernel_size,
+            'sigma': self.sigma,
+        })
+        return config
+
+    def permute(self, inputs):
+        return depthwiseFilter(inputs, self.kernel)
+
+
+class RandomSharpen(RandomPermutation):
+    '''
+    Batched counterpart of albumentations.Sharpen.
+
+    The kernel (1 - alpha) * identity + alpha * effect(lightness) is linear
+    in alpha and lightness, so it is applied as a single fixed-kernel
+    convolution whose result is blended per image.
+    '''
+    def __init__(self, alpha=(0.2, 0.5), lightness=(0.5, 1.0), **kwargs):
+
+        super(RandomSharpen, self).__init__(**kwargs)
+
+        self.alpha = alpha
+        self.lightness = lightness
+        self.kernel = [[-1, -1, -1], [-1, 8, -1], [-1, -1, -1]]
+
+    def get_config(self):
+
+        config = super().get_config().copy()
+        config.update({
+            'alpha': self.alpha,
+            'lightness': self.lightness,
+        })
+        return config
+
+    def permute(self, inputs):
+        alpha = self.sampleUniform(inputs, self.alpha[0], self.alpha[1])
+        lightness = self.sampleUniform(inputs, self.lightness[0], self.lightness[1])
+        effect = depthwiseFilter(inputs, self.kernel) + lightness * inputs
+        x = inputs + alpha * (effect - inputs)
+        return tf.clip_by_value(x, 0.0, self.max_value)
+
+
+class RandomEmboss(RandomPermutation):
+    '''
+    Batched counterpart of albumentations.Emboss.
+
+    The effect kernel is split into a constant part and a part scaled by
+    strength, so two fixed-kernel convolutions cover every sampled strength.
+    '''
+    def __init__(self, alpha=(0.2, 0.5), strength=(0.2, 0.7), **kwargs):
+
+        super(RandomEmboss, self).__init__(**kwargs)
+
+        self.alpha = alpha
+        self.strength = strength
+        self.kernel_base = [[-1, 0, 0], [0, 1, 0], [0, 0, 1]]
+        self.kernel_strength = [[-1, -1, 0], [-1, 0, 1], [0, 1, 1]]
+
+    def get_config(self):
+
+        config = super().get_config().copy()
+        config.update({
+            'alpha': self.alpha,
+            'strength': self.strength,
+        })
+        return config
+
+    def permute(self, inputs):
+        alpha = self.sampleUniform(inputs, self.alpha[0], self.alpha[1])
+        strength = self.sampleUniform(inputs, self.strength[0], self.strength[1])
+        effect = depthwiseFilter(inputs, self.kernel_base) + strength * depthwiseFilter(inputs, self.kernel_strength)
+        x = inputs + alpha * (effect - inputs)
+        return tf.clip_by_value(x, 0.0, self.max_value)
+
+
+class RandomBrightnessContrast(RandomPermutation):
+    '''
+    Batched counterpart of albumentations.RandomBrightnessContrast.
+    '''
+    def __init__(self, brightness_limit=0.2, contrast_limit=0.2, **kwargs):
+
+        super(RandomBrightnessContrast, self).__init__(**kwargs)
+
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+
+    def get_config(self):
+
+        config = super().get_config().copy()
+        config.update({
+            'brightness_limit': self.brightness_limit,
+            'contrast_limit': self.contrast_limit,
+        })
+        return config
+
+    def permute(self, inputs):
+        alpha = 1.0 + self.sampleUniform(inputs, -self.contrast_limit, self.contrast_limit)
+        beta = self.sampleUniform(inputs, -self.brightness_limit, self.brightness_limit)
+        x = inputs * alpha + beta * self.max_value
+        return tf.clip_by_value(x, 0.0, self.max_value)
+
+
+class RandomSaturation(RandomPermutation):
+    '''
+    Batched counterpart of the saturation shift of albumentations.HueSaturationValue.
+    sat_shift_limit is given in [0, 255] units as in albumentations.
+    '''
+    def __init__(self, sat_shift_limit=(-30, 30), **kwargs):
+
+        super(RandomSaturation, self).__init__(**kwargs)
+
+        self.sat_shift_limit = sat_shift_limit
+
+    def get_config(self):
+
+        config = super().get_config().copy()
+        config.update({'sat_shift_limit': self.sat_shift_limit})
+        return config
+
+    def permute(self, inputs):
+        shift = self.sampleUniform(inputs, self.sat_shift_limit[0] / 255, self.sat_shift_limit[1] / 255)
+        hsv = tf.image.rgb_to_hsv(tf.clip_by_value(inputs / self.max_value, 0.0, 1.0))
+        saturation = tf.clip_by_value(hsv[..., 1:2] + shift, 0.0, 1.0)
+        hsv = tf.concat([hsv[..., 0:1], saturation, hsv[..., 2:3]], axis=-1)
+        return tf.image.hsv_to_rgb(hsv) * self.max_value
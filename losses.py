@@ -186,6 +186,59 @@ def rootMeanSquaredErrorLossWrapper(reduction):
     return rootMeanSquaredErrorLoss
 
 
+def sampledSoftmaxLossWrapper(prediction_layer, num_sampled, num_classes):
+    """
+    sampled softmax loss, scores the true class and num_sampled sampled classes instead of all classes
+    only used for training, the full prediction layer is still used for validation and inference
+
+    references
+        https://www.tensorflow.org/api_docs/python/tf/nn/sampled_softmax_loss
+
+    parameters
+    ----------
+        prediction_layer : tf.keras.layers.Dense
+            last layer of the model, its kernel and bias are used as class weights
+
+        num_sampled : integer
+            number of classes to sample per batch
+
+        num_classes : integer
+            number of classes
+
+    returns
+    -------
+        sampledSoftmaxLoss : function
+            function that returns per-sample loss
+    """
+
+    def sampledSoftmaxLoss(y_true, features):
+        """
+        calculates per-sample sampled softmax loss
+
+        parameters
+        ----------
+            y_true : tensor
+                sparse class indices
+
+            features : tensor
+                inputs of the prediction layer
+
+        returns
+        -------
+            sampled_loss : tensor
+                loss of every sample
+        """
+
+        sampled_loss = tf.nn.sampled_softmax_loss(
+            weights=tf.transpose(prediction_layer.kernel), biases=prediction_layer.bias, 
+            labels=tf.reshape(tf.cast(y_true, tf.int64), (-1, 1)), inputs=tf.cast(features, tf.float32), 
+            num_sampled=num_sampled, num_classes=num_classes)
+
+        return sampled_loss
+
+    return sampledSoftmaxLoss
+
+
 def logisticLoss(y_true, y_pred):
     """
     computes logistic cost function.
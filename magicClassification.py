@@ -1,21 +1,23 @@
 from globalVariables import (
-    NUM_EPOCHS, START_EPOCH, BATCH_SIZES, 
+    NUM_EPOCHS, START_EPOCH, BATCH_SIZES, PHYSICAL_BATCH_SIZE, GRAD_ACCUM_STEPS, 
+    AUTO_BATCH_SIZE, BATCH_SIZE_MIN, BATCH_SIZE_MULT, BATCH_MEMORY_FRACTION, 
     INPUT_SHAPE,
     USE_TFIMM_MODELS, BUILD_ARC,
     IMAGENET_WEIGHTS, EFFNET_WEIGHTS,
     LOAD_FEATURES, NUM_ADD_CLASSES, CONCAT_FEATURES_BEFORE, CONCAT_FEATURES_AFTER, 
     MODEL_POOLING, DROP_CONNECT_RATE, INITIAL_DROPOUT, DO_BATCH_NORM, FC_LAYERS, DROPOUT_RATES, GAP_IDXS,
     ARC_DROPOUT, ARC_DENSE,      
-    DO_PREDICTIONS, NUM_CLASSES, OUTPUT_ACTIVATION,
-    UNFREEZE, UNFREEZE_FULL, UNFREEZE_PERCENT, UNFREEZE_BATCHNORM, NUM_UNFREEZE_LAYERS,
+    DO_PREDICTIONS, NUM_CLASSES, OUTPUT_ACTIVATION, SAMPLED_SOFTMAX, NUM_SAMPLED,
+    UNFREEZE, UNFREEZE_FULL, UNFREEZE_PERCENT, UNFREEZE_BATCHNORM, NUM_UNFREEZE_LAYERS, EXTRACT_FEATURES,
     LOAD_WEIGHTS, LOAD_MODEL,
     BUILD_AUTOENCODER, 
     DATA_FILEPATHS, TRAIN_FILEPATHS, VAL_FILEPATHS, DO_VALIDATION, VAL_SPLIT, MAX_FILES_PER_PART, RANDOM_STATE,
+    DATA_FORMAT, TFRECORDS_DIR, MEMMAP_DIR, UINT8_PIPELINE, MIXED_PRECISION_POLICY, CROSS_DEVICE_OPS, COOLDOWN_SECONDS, JIT_COMPILE, NUM_CPU_THREADS, DEVICE_PREFETCH_BUFFER, CACHE_DIR, SHUFFLE_BUFFER_SIZE,
     METADATA, ID_COLUMN, TARGET_FEATURE_COLUMNS, ADD_FEATURES_COLUMNS, 
     FILENAME_UNDERSCORE, CREATE_ONEHOT, CREATE_SPARSE, LABEL_IDX, LABEL_IDXS_ADD,     
     DO_KFOLD, NUM_FOLDS, 
     CLASSIFICATION_CHECKPOINT_PATH, TRAINED_MODELS_PATH, 
-    SAVE_TRAIN_WEIGHTS_DIR, SAVE_TRAIN_INFO_DIR,
+    SAVE_TRAIN_WEIGHTS_DIR, SAVE_TRAIN_INFO_DIR, EXPORT_TFLITE, NUM_CALIBRATION_BATCHES,
     ARCMARGIN_S, ARCMARGIN_M,
     OPTIMIZER, LEARNING_RATE, MOMENTUM_VALUE, NESTEROV,
     CUSTOM_LRS_EPOCHS,
@@ -23,412 +25,466 @@ from globalVariables import (
     LR_CUSTOM_DECAY, LR_START_DECAY, LR_MAX_DECAY, LR_MIN_DECAY, LR_RAMP_EP_DECAY, LR_SUS_EP_DECAY, LR_VALUE_DECAY,
     LR_LADDER, LR_LADDER_STEP, LR_LADDER_EPOCHS,
     REDUCE_LR_PLATEAU, REDUCE_LR_PATIENCE, REDUCE_LR_FACTOR, REDUCE_LR_MINIMAL_LR, REDUCE_LR_METRIC,   
-    PERMUTATIONS_CLASSIFICATION, DO_PERMUTATIONS,
+    PERMUTATIONS_CLASSIFICATION, getPermutationsClassificationGPU, DO_PERMUTATIONS, DO_PERMUTATIONS_GPU,
     FROM_LOGITS, LABEL_SMOOTHING, LOSS_REDUCTION, 
     METRIC_TYPE, ACCURACY_THRESHOLD, F1_SCORE_AVERAGE, F1_SCORE_THRESHOLD,
     BUILD_AUTOENCODER, DENSE_NEURONS_DATA_FEATURES, DENSE_NEURONS_ENCODER, DENSE_NEURONS_BOTTLE, DENSE_NEURONS_DECODER)
 
 from models import (
     MODELS_CLASSIFICATION, TFIMM_MODELS, 
-    unfreezeModel, 
+    unfreezeModel, splitFrozenModel, 
     buildClassificationImageNetModel, buildDenoisingAutoencoder, buildTFIMM, buildArcModel)
 from layers import unfreezeLayers
-from train import classificationCustomTrain
+from train import classificationCustomStepsWrapper, classificationCustomTrain, probeBatchSize
+from prepareTrainDataset import preprocessBatch, prepareStreamingDataset, writeTFRecordShards, prepareTFRecordDataset, writeMemmapShards, prepareMemmapDataset, prepareFeatureDataset
+from callbacks import saveTFLiteModel
 from preprocessFunctions import kerasNormalize
-from losses import categoricalFocalLossWrapper, binaryFocalLossWrapper
+from losses import categoricalFocalLossWrapper, binaryFocalLossWrapper, sampledSoftmaxLossWrapper
 from optimizers import getLRCallback
 from metrics import map5Wrapper, f1Wrapper
-from helpers import getFullPaths
+from helpers import getFullPaths, getCrossDeviceOps, getMixedPrecisionPolicy
 
+import gc
+from concurrent.futures import ThreadPoolExecutor
 import time
 import os
 import numpy as np
-from sklearn.model_selection import KFold
 from sklearn.utils import shuffle
 from sklearn.model_selection import train_test_split
 
 import tensorflow_addons as tfa
 import tensorflow as tf
 import tensorflow.keras.backend as K
-import tfimm
 import keras
 import efficientnet.keras as efn 
-from tensorflow.keras.models import load_model
 
-gpus = tf.config.experimental.list_physical_devices('GPU')
-for gpu in gpus:
-    tf.config.experimental.set_memory_growth(gpu, True)
 
-strategy = tf.distribute.MirroredStrategy(
-    devices=["GPU:0", "GPU:1"], cross_device_ops=tf.distribute.HierarchicalCopyAllReduce())
-
-
-def classificationCustom():
+def classificationCustom(strategy):
     """
     main working function that starts the whole training process for classification or encoding-decoding tasks
     it does the following:
         - creates a list with paths to training files
+        - builds streaming tf.data pipelines for training and validation files
         - iterates through every model initialized in models.py
-        - if DO_KFOLD = True it iterates through every fold for each model
+        - if DO_KFOLD = True it iterates through every fold for each model,
+          the model is built once and its weights, optimizer and metrics are reset before every fold
         - initializes as much input layers as needed, as well as additional input feature layers
         - creates a model:
             - if BUILD_AUTOENCODER = True it creates an autoencoder with ImageNet model body instead of a modified ImageNet model
             - otherwise it either creates a modified ImageNet model (read more in description of buildClassificationImageNetModel function in models.py file)
             - or any custom model initialized in models.py file
         - if UNFREEZE = True it unfrezees either all layers or a specific number of top layers in the model (transfer learning)
+        - if UNFREEZE = False and EXTRACT_FEATURES = True it computes outputs of the frozen body once and trains only head layers on them
         - optionally loads model weights from a training checkpoint or a whole pretrained model
         - initializes loss function, learning rate, optimizer and metrics
         - if DO_VALIDATION = True it will check a model perfomance after every training epoch
         - calls a function that starts a training process and passes all initialized variables to it
     every action is based on the global variables initialized in globalVariables.py
+
+    parameters
+    ----------
+
+        strategy : tf.distribute object
+            TensorFlow API used in distributed training, created after the mixed precision policy is set
     """
 
+    # the loss is picked from the label format, so the output activation has to match it
+    # (no activation if FROM_LOGITS = True)
+    if FROM_LOGITS:
+        expected_activation = None
+    elif CREATE_SPARSE:
+        expected_activation = 'softmax'
+    else:
+        expected_activation = 'sigmoid'
+
+    if OUTPUT_ACTIVATION != expected_activation:
+        raise ValueError(
+            'OUTPUT_ACTIVATION = ' + str(OUTPUT_ACTIVATION) + ' does not match the loss, expected ' + str(expected_activation) 
+            + ' for CREATE_SPARSE = ' + str(CREATE_SPARSE) + ' and FROM_LOGITS = ' + str(FROM_LOGITS))
+
+    if SAMPLED_SOFTMAX and not CREATE_SPARSE:
+        raise ValueError('SAMPLED_SOFTMAX needs sparse labels, set CREATE_SPARSE = True')
+
+    if DO_PERMUTATIONS_GPU:
+        permutations = getPermutationsClassificationGPU()
+    else:
+        permutations = PERMUTATIONS_CLASSIFICATION
+
     data_paths_list = np.array(getFullPaths(DATA_FILEPATHS))
     data_paths_list_shuffled = shuffle(data_paths_list, random_state=RANDOM_STATE)
 
-    for model_name, model_imagenet in MODELS_CLASSIFICATION.items():
-
-        batch_size_per_replica = BATCH_SIZES[model_name]
-        batch_size = batch_size_per_replica * strategy.num_replicas_in_sync
+    # folds depend only on the paths, so split once and reuse them for every model
+    # one fold id per path is kept instead of train and validation index arrays of every fold
+    if DO_KFOLD:
+        from sklearn.model_selection import KFold
+        kfold = KFold(NUM_FOLDS, shuffle=True, random_state=RANDOM_STATE)
+        fold_ids = np.empty(len(data_paths_list_shuffled), dtype=np.int32)
+        for fold, (train_ix, val_ix) in enumerate(kfold.split(data_paths_list_shuffled)):
+            fold_ids[val_ix] = fold
+
+    # both sharded formats are written and read with the same call signatures
+    if DATA_FORMAT == 'memmap':
+        writeShards, prepareShardedDataset, shards_dir = writeMemmapShards, prepareMemmapDataset, MEMMAP_DIR
+    else:
+        writeShards, prepareShardedDataset, shards_dir = writeTFRecordShards, prepareTFRecordDataset, TFRECORDS_DIR
+
+    # convert files to uint8 shards once, every fold's validation files go into separate shards
+    # so that training shards of a fold are the shards of all other folds
+    # splits are converted concurrently, loading and writing files mostly runs outside of the GIL
+    if DATA_FORMAT in ('tfrecord', 'memmap'):
+        with ThreadPoolExecutor() as executor:
+            if DO_KFOLD:
+                fold_shard_futures = [executor.submit(
+                    writeShards, 
+                    data_paths_list_shuffled[fold_ids == fold], shards_dir, 'fold_' + str(fold), MAX_FILES_PER_PART, LABEL_IDX) 
+                    for fold in range(NUM_FOLDS)]
+                fold_shard_paths = [future.result() for future in fold_shard_futures]
+            else:
+                train_shard_future = executor.submit(
+                    writeShards, 
+                    getFullPaths(TRAIN_FILEPATHS), shards_dir, 'train', MAX_FILES_PER_PART, LABEL_IDX)
+                if DO_VALIDATION:
+                    val_shard_paths = executor.submit(
+                        writeShards, 
+                        getFullPaths(VAL_FILEPATHS), shards_dir, 'val', MAX_FILES_PER_PART, LABEL_IDX).result()
+                else:
+                    val_shard_paths = None
+                train_shard_paths = train_shard_future.result()
 
-        if DO_KFOLD:
+    # K-fold training runs once per fold, otherwise there is a single run on the training and validation files
+    # all folds of a model share one model, optimizer and the traced (and XLA-compiled) training and validation steps
+    if DO_KFOLD:
+        folds = list(range(NUM_FOLDS))
+    else:
+        folds = [None]
 
-            kfold = KFold(NUM_FOLDS, shuffle=True, random_state=RANDOM_STATE)
+    # outputs of a frozen ImageNet body are the same every epoch, so it is run once per run and only head layers are trained
+    extract_features = (
+        EXTRACT_FEATURES and (not UNFREEZE) and (MODEL_POOLING in ('avg', 'max')) 
+        and not (BUILD_AUTOENCODER or USE_TFIMM_MODELS or BUILD_ARC or LOAD_FEATURES))
 
-            for fold, (train_ix, val_ix) in enumerate(kfold.split(data_paths_list_shuffled)):
-                
-                train_paths_list = np.ndarray.tolist(data_paths_list_shuffled[train_ix])
-                val_paths_list = np.ndarray.tolist(data_paths_list_shuffled[val_ix])
+    for model_name, model_imagenet in MODELS_CLASSIFICATION.items():
 
-                max_fileparts_train = len(train_paths_list) // MAX_FILES_PER_PART
-                max_fileparts_val = len(val_paths_list) // MAX_FILES_PER_PART
+        batch_size_per_replica = PHYSICAL_BATCH_SIZE
+        batch_size = batch_size_per_replica * strategy.num_replicas_in_sync
+        grad_accum_steps = GRAD_ACCUM_STEPS[model_name]
 
-                with strategy.scope():
+        with strategy.scope():
 
-                    # create model, loss, optimizer and metrics instances here
-                    # reset model, optimizer (AND learning rate), loss and metrics after each iteration
+            # create model, loss, optimizer and metrics instances once per model
+            # they are reset to their initial state at the start of every fold instead of being rebuilt,
+            # training and validation steps built from them below are traced and XLA-compiled only in the first fold
 
-                    input_data_layer = tf.keras.layers.Input(shape=(INPUT_SHAPE[0], INPUT_SHAPE[1], INPUT_SHAPE[2], ), name='input_data_layer')
-                    if LOAD_FEATURES:
-                        input_features_layers = []
-                        for idx, features in enumerate(NUM_ADD_CLASSES):
-                            input_features_layer = tf.keras.layers.Input(shape=(), name=('input_features_layer_' + str(idx)))
-                            input_features_layers.append(input_features_layer)
-                        input_layers = [input_data_layer + input_features_layers]
-                    else:
-                        input_layers = [input_data_layer]
+            input_data_layer = tf.keras.layers.Input(shape=(INPUT_SHAPE[0], INPUT_SHAPE[1], INPUT_SHAPE[2], ), name='input_data_layer')
+            if LOAD_FEATURES:
+                input_features_layers = []
+                for idx, features in enumerate(NUM_ADD_CLASSES):
+                    input_features_layer = tf.keras.layers.Input(shape=(), name=('input_features_layer_' + str(idx)))
+                    input_features_layers.append(input_features_layer)
+                input_layers = [input_data_layer + input_features_layers]
+            else:
+                input_layers = [input_data_layer]
 
-                    normalization_function = kerasNormalize(model_name)
+            normalization_function = kerasNormalize(model_name)
 
-                    if BUILD_AUTOENCODER:
+            if BUILD_AUTOENCODER:
 
-                        model = buildDenoisingAutoencoder(
-                            input_layers, 
-                            model_name, model_imagenet,
-                            MODEL_POOLING, DROP_CONNECT_RATE, DO_BATCH_NORM, INITIAL_DROPOUT,
-                            CONCAT_FEATURES_BEFORE, CONCAT_FEATURES_AFTER, 
-                            FC_LAYERS, DROPOUT_RATES,
-                            NUM_CLASSES, OUTPUT_ACTIVATION, 
-                            DO_PREDICTIONS,
-                            DENSE_NEURONS_DATA_FEATURES, DENSE_NEURONS_ENCODER, DENSE_NEURONS_BOTTLE, DENSE_NEURONS_DECODER,
-                            NUM_ADD_CLASSES)
+                model = buildDenoisingAutoencoder(
+                    input_layers,
+                    model_name, model_imagenet,
+                    MODEL_POOLING, DROP_CONNECT_RATE, DO_BATCH_NORM, INITIAL_DROPOUT,
+                    CONCAT_FEATURES_BEFORE, CONCAT_FEATURES_AFTER,
+                    FC_LAYERS, DROPOUT_RATES,
+                    NUM_CLASSES, OUTPUT_ACTIVATION,
+                    DO_PREDICTIONS,
+                    DENSE_NEURONS_DATA_FEATURES, DENSE_NEURONS_ENCODER, DENSE_NEURONS_BOTTLE, DENSE_NEURONS_DECODER,
+                    NUM_ADD_CLASSES)
 
-                    elif USE_TFIMM_MODELS:
+            elif USE_TFIMM_MODELS:
 
-                        model, normalization_function = buildTFIMM(
-                            input_layers, 
-                            model_name, 
-                            FC_LAYERS, NUM_CLASSES, OUTPUT_ACTIVATION, 
-                            LOAD_MODEL, CLASSIFICATION_CHECKPOINT_PATH)
+                model, normalization_function = buildTFIMM(
+                    input_layers,
+                    model_name,
+                    FC_LAYERS, NUM_CLASSES, OUTPUT_ACTIVATION,
+                    LOAD_MODEL, CLASSIFICATION_CHECKPOINT_PATH)
 
-                    else:
-                        
-                        if LOAD_MODEL:
+            else:
 
-                            model = load_model(CLASSIFICATION_CHECKPOINT_PATH)
-                        
-                        else:
+                model = buildClassificationImageNetModel(
+                    input_layers,
+                    model_name, model_imagenet, IMAGENET_WEIGHTS,
+                    MODEL_POOLING, DROP_CONNECT_RATE, DO_BATCH_NORM, INITIAL_DROPOUT,
+                    CONCAT_FEATURES_BEFORE, CONCAT_FEATURES_AFTER,
+                    FC_LAYERS, DROPOUT_RATES, GAP_IDXS,
+                    NUM_CLASSES, OUTPUT_ACTIVATION,
+                    DO_PREDICTIONS)
 
-                            model = buildClassificationImageNetModel(
-                                input_layers, 
-                                model_name, model_imagenet, IMAGENET_WEIGHTS,
-                                MODEL_POOLING, DROP_CONNECT_RATE, DO_BATCH_NORM, INITIAL_DROPOUT, 
-                                CONCAT_FEATURES_BEFORE, CONCAT_FEATURES_AFTER, 
-                                FC_LAYERS, DROPOUT_RATES, GAP_IDXS,
-                                NUM_CLASSES, OUTPUT_ACTIVATION, 
-                                DO_PREDICTIONS)
+                if LOAD_MODEL:
 
-                        if UNFREEZE: 
+                    # only weights are restored from the saved model into the built architecture,
+                    # its graph and optimizer state are not deserialized
+                    # every variable of the built model has to be restored, otherwise loading fails instead of 
+                    # silently training from initial weights, values that only the saved model has are left unused
+                    load_status = model.load_weights(
+                        os.path.join(CLASSIFICATION_CHECKPOINT_PATH, 'variables', 'variables'))
+                    load_status.assert_existing_objects_matched()
+                    load_status.expect_partial()
 
-                            num_model_layers = len(model.layers)
+                if UNFREEZE:
 
-                            to_unfreeze = unfreezeLayers(
-                                num_model_layers, 
-                                UNFREEZE_FULL, UNFREEZE_PERCENT, NUM_UNFREEZE_LAYERS,
-                                model_name)
+                    num_model_layers = len(model.layers)
 
-                            model = unfreezeModel(model, len(input_layers), DO_BATCH_NORM, to_unfreeze, UNFREEZE_BATCHNORM)
+                    to_unfreeze = unfreezeLayers(
+                        num_model_layers,
+                        UNFREEZE_FULL, UNFREEZE_PERCENT, NUM_UNFREEZE_LAYERS,
+                        model_name)
 
-                        if LOAD_WEIGHTS:
+                    model = unfreezeModel(model, len(input_layers), DO_BATCH_NORM, to_unfreeze, UNFREEZE_BATCHNORM)
 
-                            model.load_weights(CLASSIFICATION_CHECKPOINT_PATH)
+                if LOAD_WEIGHTS:
 
-                        if BUILD_ARC:
+                    model.load_weights(CLASSIFICATION_CHECKPOINT_PATH)
 
-                            model = buildArcModel(
-                                input_layers, model, 
-                                ARC_DROPOUT, ARC_DENSE, NUM_CLASSES, 
-                                ARCMARGIN_S, ARCMARGIN_M)
+                if BUILD_ARC:
 
-                    # loss_object = categoricalFocalLossWrapper(reduction=LOSS_REDUCTION)
-                    loss_object = tf.losses.SparseCategoricalCrossentropy(
-                        from_logits=FROM_LOGITS, name='train_SCC_loss', reduction=tf.keras.losses.Reduction.NONE)
+                    model = buildArcModel(
+                        input_layers, model,
+                        ARC_DROPOUT, ARC_DENSE, NUM_CLASSES,
+                        ARCMARGIN_S, ARCMARGIN_M)
 
-                    def compute_total_loss(labels, predictions):
-                        per_gpu_loss = loss_object(labels, predictions)
-                        return tf.nn.compute_average_loss(
-                            per_gpu_loss, global_batch_size=batch_size)
+            if AUTO_BATCH_SIZE:
 
-                    val_loss = tf.keras.metrics.Mean(name='val_SCC_mean_loss')
+                batch_size_per_replica = probeBatchSize(
+                    model, INPUT_SHAPE, BATCH_SIZE_MIN, BATCH_SIZE_MULT, BATCH_MEMORY_FRACTION, 'GPU:0')
+                batch_size = batch_size_per_replica * strategy.num_replicas_in_sync
+                # rounded up like GRAD_ACCUM_STEPS, the effective batch is batch_size * grad_accum_steps
+                grad_accum_steps = int(np.ceil(BATCH_SIZES[model_name] / batch_size_per_replica))
 
-                    if LR_EXP:
+            # head_model shares weights with model, only its variables are trained and saved
+            if extract_features:
+                body_model, head_model = splitFrozenModel(model, MODEL_POOLING)
+            else:
+                body_model, head_model = None, model
 
-                        exp_learning_rate = tf.keras.optimizers.schedules.ExponentialDecay(
-                            initial_learning_rate=LEARNING_RATE, decay_steps=LR_DECAY_STEPS, decay_rate=LR_DECAY_RATE)
-                        optimizer = tf.keras.optimizers.Adam(learning_rate=exp_learning_rate)
+            # one-hot (multi-hot after mixing) labels are trained as independent sigmoid outputs,
+            # sparse labels hold a single class and are trained with softmax
+            if CREATE_SPARSE:
+                loss_object = tf.losses.SparseCategoricalCrossentropy(
+                    from_logits=FROM_LOGITS, name='train_SCC_loss', reduction=tf.keras.losses.Reduction.NONE)
+            else:
+                loss_object = binaryFocalLossWrapper(reduction=None)
 
-                    elif LR_CUSTOM_DECAY:
+            if SAMPLED_SOFTMAX:
 
-                        RESUME_TRAINING = True if (START_EPOCH != 0) else False
-                        # schedule = getLRCallback(
-                        #     LR_START_DECAY, LR_MAX_DECAY, LR_MIN_DECAY, LR_RAMP_EP_DECAY, LR_SUS_EP_DECAY, LR_VALUE_DECAY,
-                        #     batch_size, epoch)
-                        decay_learning_rate = tf.keras.optimizers.schedules.LearningRateSchedule(getLRCallback)
-                        optimizer = tf.keras.optimizers.Adam(learning_rate=decay_learning_rate)
+                # training forward pass stops at the inputs of the prediction layer,
+                # the loss only multiplies them with weights of the true and sampled classes
+                train_model = tf.keras.Model(inputs=head_model.inputs, outputs=head_model.layers[-1].input)
+                train_loss_object = sampledSoftmaxLossWrapper(head_model.layers[-1], NUM_SAMPLED, NUM_CLASSES)
+                # candidate sampling ops have no XLA kernels
+                jit_compile = False
 
-                    else:
+            else:
 
-                        if OPTIMIZER == 'Adam':
-                            optimizer = tf.keras.optimizers.Adam(learning_rate=LEARNING_RATE)
-                        
-                        elif OPTIMIZER == 'SGD':
-                            optimizer = tf.keras.optimizers.SGD(
-                                learning_rate=LEARNING_RATE, momentum=MOMENTUM_VALUE, nesterov=NESTEROV)
-
-                    train_metric_1 = tf.keras.metrics.SparseCategoricalAccuracy(name='train_SCA_metric')
-                    train_metric_2 = tf.keras.metrics.SparseTopKCategoricalAccuracy(k=5, name='train_STOPKCA_metric')
-                    train_metrics = [train_metric_1, train_metric_2]
-
-                    val_metric_1 = tf.keras.metrics.SparseCategoricalAccuracy(name='val_SCA_metric')
-                    val_metric_2 = tf.keras.metrics.SparseTopKCategoricalAccuracy(k=5, name='val_STOPKCA_metric')
-                    val_metrics = [val_metric_1, val_metric_2]
-
-                    # train_metric = map5Wrapper()
-                    # val_metric = map5Wrapper()
-
-                    # rename optimizer weights to train multiple models
-                    with K.name_scope(optimizer.__class__.__name__):
-                        for i, var in enumerate(optimizer.weights):
-                            name = 'variable{}'.format(i)
-                            optimizer.weights[i] = tf.Variable(
-                                var, name=name)
-
-                classificationCustomTrain(
-                    NUM_EPOCHS, START_EPOCH, batch_size, NUM_CLASSES, NUM_ADD_CLASSES,  
-                    train_paths_list, val_paths_list, DO_VALIDATION, max_fileparts_train, max_fileparts_val, fold,
-                    METADATA, ID_COLUMN, TARGET_FEATURE_COLUMNS, ADD_FEATURES_COLUMNS, 
-                    FILENAME_UNDERSCORE, CREATE_ONEHOT, CREATE_SPARSE, LABEL_IDX, LABEL_IDXS_ADD, 
-                    PERMUTATIONS_CLASSIFICATION, DO_PERMUTATIONS, normalization_function,
-                    model_name, model,
-                    loss_object, val_loss, compute_total_loss,
-                    CUSTOM_LRS_EPOCHS,
-                    LR_LADDER, LR_LADDER_STEP, LR_LADDER_EPOCHS, 
-                    REDUCE_LR_PLATEAU, REDUCE_LR_PATIENCE, REDUCE_LR_FACTOR, REDUCE_LR_MINIMAL_LR, REDUCE_LR_METRIC,
-                    optimizer,
-                    METRIC_TYPE, train_metrics, val_metrics,
-                    SAVE_TRAIN_INFO_DIR, SAVE_TRAIN_WEIGHTS_DIR,
-                    strategy)
-
-                print('________________________________________')
-                print('\n')
-                print('TRAINING FINISHED FOR ' + model_name + ', fold ' + str(fold + 1) + '/' + str(NUM_FOLDS) + ' !')
-                print('\n')
-                print('________________________________________')
+                train_model = head_model
+                train_loss_object = loss_object
+                jit_compile = JIT_COMPILE
 
-                del train_paths_list
-                del val_paths_list
-                del max_fileparts_train
-                del max_fileparts_val
-                del model
-                del loss_object
-                del val_loss
-                del optimizer
-                del train_metrics
-                del val_metrics
+            def compute_total_loss(labels, predictions):
+                per_gpu_loss = train_loss_object(labels, predictions)
+                # averaged over the effective batch, so that gradients summed over micro-batches are a mean
+                return tf.nn.compute_average_loss(
+                    per_gpu_loss, global_batch_size=(batch_size * grad_accum_steps))
 
-                K.clear_session()
+            if CREATE_SPARSE:
+                val_loss = tf.keras.metrics.Mean(name='val_SCC_mean_loss')
+            else:
+                val_loss = tf.keras.metrics.Mean(name='val_BC_mean_loss')
 
-                # sleep 120 seconds
-                print('Sleeping 120 seconds after training ' + model_name + ', fold ' + str(fold + 1) + '/' + str(NUM_FOLDS) + '. Zzz...')
-                time.sleep(120)
+            # unique optimizer name gives slot variables of every model their own name scope
+            optimizer_name = OPTIMIZER + '_' + model_name
 
-        else:
+            if LR_EXP:
 
-            train_paths_list = getFullPaths(TRAIN_FILEPATHS)
-            max_fileparts_train = len(train_paths_list) // MAX_FILES_PER_PART
-            if max_fileparts_train == 0:
-                max_fileparts_train = 1
+                exp_learning_rate = tf.keras.optimizers.schedules.ExponentialDecay(
+                    initial_learning_rate=LEARNING_RATE, decay_steps=LR_DECAY_STEPS, decay_rate=LR_DECAY_RATE)
+                optimizer = tf.keras.optimizers.Adam(learning_rate=exp_learning_rate, name=optimizer_name)
 
-            if DO_VALIDATION:
+            elif LR_CUSTOM_DECAY:
 
-                val_paths_list = getFullPaths(VAL_FILEPATHS)
-                max_fileparts_val = len(val_paths_list) // MAX_FILES_PER_PART
-                if max_fileparts_val == 0:
-                    max_fileparts_val = 1
+                RESUME_TRAINING = True if (START_EPOCH != 0) else False
+                # schedule = getLRCallback(
+                #     LR_START_DECAY, LR_MAX_DECAY, LR_MIN_DECAY, LR_RAMP_EP_DECAY, LR_SUS_EP_DECAY, LR_VALUE_DECAY,
+                #     batch_size, epoch)
+                decay_learning_rate = tf.keras.optimizers.schedules.LearningRateSchedule(getLRCallback)
+                optimizer = tf.keras.optimizers.Adam(learning_rate=decay_learning_rate, name=optimizer_name)
 
             else:
-                val_paths_list = None
-                max_fileparts_val = None
 
-            with strategy.scope():
+                if OPTIMIZER == 'Adam':
+                    optimizer = tf.keras.optimizers.Adam(learning_rate=LEARNING_RATE, name=optimizer_name)
 
-                # create model, loss, optimizer and metrics instances here
-                # reset model, optimizer (AND learning rate), loss and metrics after each iteration
+                elif OPTIMIZER == 'SGD':
+                    optimizer = tf.keras.optimizers.SGD(
+                        learning_rate=LEARNING_RATE, momentum=MOMENTUM_VALUE, nesterov=NESTEROV, name=optimizer_name)
 
-                input_data_layer = tf.keras.layers.Input(shape=(INPUT_SHAPE[0], INPUT_SHAPE[1], INPUT_SHAPE[2], ), name='input_data_layer')
-                if LOAD_FEATURES:
-                    input_features_layers = []
-                    for idx, features in enumerate(NUM_ADD_CLASSES):
-                        input_features_layer = tf.keras.layers.Input(shape=(), name=('input_features_layer_' + str(idx)))
-                        input_features_layers.append(input_features_layer)
-                    input_layers = [input_data_layer + input_features_layers]
-                else:
-                    input_layers = [input_data_layer]
+            # validation loss and metrics are always created, they are only updated if DO_VALIDATION = True
+            if CREATE_SPARSE:
 
-                normalization_function = kerasNormalize(model_name)
+                train_metric_1 = tf.keras.metrics.SparseCategoricalAccuracy(name='train_SCA_metric')
+                train_metric_2 = tf.keras.metrics.SparseTopKCategoricalAccuracy(k=5, name='train_STOPKCA_metric')
 
-                if BUILD_AUTOENCODER:
+                val_metric_1 = tf.keras.metrics.SparseCategoricalAccuracy(name='val_SCA_metric')
+                val_metric_2 = tf.keras.metrics.SparseTopKCategoricalAccuracy(k=5, name='val_STOPKCA_metric')
 
-                    model = buildDenoisingAutoencoder(
-                        input_layers, 
-                        model_name, model_imagenet,
-                        MODEL_POOLING, DROP_CONNECT_RATE, DO_BATCH_NORM, INITIAL_DROPOUT,
-                        CONCAT_FEATURES_BEFORE, CONCAT_FEATURES_AFTER, 
-                        FC_LAYERS, DROPOUT_RATES,
-                        NUM_CLASSES, OUTPUT_ACTIVATION, 
-                        DO_PREDICTIONS,
-                        DENSE_NEURONS_DATA_FEATURES, DENSE_NEURONS_ENCODER, DENSE_NEURONS_BOTTLE, DENSE_NEURONS_DECODER,
-                        NUM_ADD_CLASSES)
+            else:
 
-                elif USE_TFIMM_MODELS:
+                train_metric_1 = tf.keras.metrics.BinaryAccuracy(threshold=ACCURACY_THRESHOLD, name='train_BA')
+                train_metric_2 = tfa.metrics.F1Score(
+                    num_classes=NUM_CLASSES, average=F1_SCORE_AVERAGE, 
+                    threshold=F1_SCORE_THRESHOLD, name='train_F1')
 
-                    model, normalization_function = buildTFIMM(
-                        input_layers, 
-                        model_name, 
-                        FC_LAYERS, NUM_CLASSES, OUTPUT_ACTIVATION, 
-                        LOAD_MODEL, CLASSIFICATION_CHECKPOINT_PATH)
+                val_metric_1 = tf.keras.metrics.BinaryAccuracy(threshold=ACCURACY_THRESHOLD, name='val_BA')
+                val_metric_2 = tfa.metrics.F1Score(
+                    num_classes=NUM_CLASSES, average=F1_SCORE_AVERAGE, 
+                    threshold=F1_SCORE_THRESHOLD, name='val_F1')
 
-                else:
+            train_metrics = [train_metric_1, train_metric_2]
+            val_metrics = [val_metric_1, val_metric_2]
 
-                    if LOAD_MODEL:
+            # train_metric = map5Wrapper()
+            # val_metric = map5Wrapper()
 
-                        model = load_model(CLASSIFICATION_CHECKPOINT_PATH)
-                    
-                    else:
+            if tf.keras.mixed_precision.global_policy().name == 'mixed_float16':
+                optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
-                        model = buildClassificationImageNetModel(
-                            input_layers, 
-                            model_name, model_imagenet, IMAGENET_WEIGHTS,
-                            MODEL_POOLING, DROP_CONNECT_RATE, DO_BATCH_NORM, INITIAL_DROPOUT, 
-                            CONCAT_FEATURES_BEFORE, CONCAT_FEATURES_AFTER, 
-                            FC_LAYERS, DROPOUT_RATES, GAP_IDXS,
-                            NUM_CLASSES, OUTPUT_ACTIVATION, 
-                            DO_PREDICTIONS)
+            # initial weights are restored before every fold instead of rebuilding the model
+            if DO_KFOLD:
+                initial_weights = model.get_weights()
 
-                    if UNFREEZE: 
+        # steps are built once per model, so only the first fold traces and compiles them
+        wrapperTrain, wrapperVal, trainPreprocessing, valPreprocessing, accumulated_gradients = classificationCustomStepsWrapper(
+            head_model,
+            permutations, DO_PERMUTATIONS, normalization_function, (UINT8_PIPELINE and not extract_features), jit_compile,
+            grad_accum_steps,
+            strategy)
 
-                        num_model_layers = len(model.layers)
+        for fold in folds:
 
-                        to_unfreeze = unfreezeLayers(
-                            num_model_layers, 
-                            UNFREEZE_FULL, UNFREEZE_PERCENT, NUM_UNFREEZE_LAYERS,
-                            model_name)
+            if DO_KFOLD:
 
-                        model = unfreezeModel(model, len(input_layers), DO_BATCH_NORM, to_unfreeze, UNFREEZE_BATCHNORM)
+                with strategy.scope():
 
-                    if LOAD_WEIGHTS:
+                    model.set_weights(initial_weights)
 
-                        model.load_weights(CLASSIFICATION_CHECKPOINT_PATH)
+                    # loss scale state of a LossScaleOptimizer is kept, only slots and iterations are reset
+                    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+                        inner_optimizer = optimizer.inner_optimizer
+                    else:
+                        inner_optimizer = optimizer
 
-                    if BUILD_ARC:
+                    for var in inner_optimizer.variables():
+                        var.assign(tf.zeros_like(var))
 
-                        model = buildArcModel(
-                            input_layers, model, 
-                            ARC_DROPOUT, ARC_DENSE, NUM_CLASSES, 
-                            ARCMARGIN_S, ARCMARGIN_M)
+                    if not isinstance(optimizer.learning_rate, tf.keras.optimizers.schedules.LearningRateSchedule):
+                        optimizer.learning_rate = LEARNING_RATE
 
+                val_loss.reset_states()
+                if METRIC_TYPE != 'custom':
+                    for metric in train_metrics + val_metrics:
+                        metric.reset_states()
 
-                # loss_object = tf.losses.BinaryCrossentropy(
-                #     from_logits=FROM_LOGITS, name='train_BC_loss', reduction=tf.keras.losses.Reduction.NONE)
-                loss_object = binaryFocalLossWrapper(reduction=None)
+            if DATA_FORMAT in ('tfrecord', 'memmap'):
 
-                def compute_total_loss(labels, predictions):
-                    per_gpu_loss = loss_object(labels, predictions)
-                    return tf.nn.compute_average_loss(
-                        per_gpu_loss, global_batch_size=batch_size)
+                if DO_KFOLD:
+                    train_split_paths = [shard_path for other_fold, shard_paths in enumerate(fold_shard_paths)
+                                         if other_fold != fold for shard_path in shard_paths]
+                    val_split_paths = fold_shard_paths[fold]
+                    num_train_files = int(np.sum(fold_ids != fold))
+                else:
+                    train_split_paths, val_split_paths = train_shard_paths, val_shard_paths
+                    num_train_files = len(getFullPaths(TRAIN_FILEPATHS))
+
+                shuffle_buffer_size = num_train_files if SHUFFLE_BUFFER_SIZE is None else SHUFFLE_BUFFER_SIZE
+
+                train_dataset = prepareShardedDataset(
+                    batch_size, NUM_CLASSES,
+                    train_split_paths,
+                    CREATE_ONEHOT, CREATE_SPARSE,
+                    permutations, DO_PERMUTATIONS, normalization_function, UINT8_PIPELINE,
+                    CACHE_DIR, shuffle_buffer_size, DEVICE_PREFETCH_BUFFER,
+                    strategy, is_val=extract_features)
 
                 if DO_VALIDATION:
-                    val_loss = tf.keras.metrics.Mean(name='val_BC_mean_loss')
+                    val_dataset = prepareShardedDataset(
+                        batch_size, NUM_CLASSES,
+                        val_split_paths,
+                        CREATE_ONEHOT, CREATE_SPARSE,
+                        None, DO_PERMUTATIONS, normalization_function, UINT8_PIPELINE,
+                        CACHE_DIR, shuffle_buffer_size, DEVICE_PREFETCH_BUFFER,
+                        strategy, is_val=True)
                 else:
-                    val_loss = None
+                    val_dataset = None
 
-                if LR_EXP:
-                    exp_learning_rate = tf.keras.optimizers.schedules.ExponentialDecay(
-                        initial_learning_rate=LEARNING_RATE, decay_steps=LR_DECAY_STEPS, decay_rate=LR_DECAY_RATE)
-                    optimizer = tf.keras.optimizers.Adam(learning_rate=exp_learning_rate)
+            else:
 
+                # paths are only selected when they are streamed, sharded formats read fold shards instead
+                if DO_KFOLD:
+                    val_mask = (fold_ids == fold)
+                    train_split_paths = data_paths_list_shuffled[~val_mask]
+                    val_split_paths = data_paths_list_shuffled[val_mask]
                 else:
+                    train_split_paths = getFullPaths(TRAIN_FILEPATHS)
+                    val_split_paths = getFullPaths(VAL_FILEPATHS) if DO_VALIDATION else None
 
-                    if OPTIMIZER == 'Adam':
-                        optimizer = tf.keras.optimizers.Adam(learning_rate=LEARNING_RATE)
-                    
-                    elif OPTIMIZER == 'SGD':
-                        optimizer = tf.keras.optimizers.SGD(
-                            learning_rate=LEARNING_RATE, momentum=MOMENTUM_VALUE, nesterov=NESTEROV)
+                shuffle_buffer_size = len(train_split_paths) if SHUFFLE_BUFFER_SIZE is None else SHUFFLE_BUFFER_SIZE
 
-                train_metric_1 = tf.keras.metrics.BinaryAccuracy(threshold=ACCURACY_THRESHOLD, name='train_BA')
-                train_metric_2 = tfa.metrics.F1Score(
-                    num_classes=NUM_CLASSES, average=F1_SCORE_AVERAGE, 
-                    threshold=F1_SCORE_THRESHOLD, name='train_F1')
-                train_metrics = [train_metric_1, train_metric_2]
+                train_dataset = prepareStreamingDataset(
+                    batch_size, NUM_CLASSES,
+                    train_split_paths,
+                    METADATA, ID_COLUMN, TARGET_FEATURE_COLUMNS,
+                    FILENAME_UNDERSCORE, CREATE_ONEHOT, CREATE_SPARSE, LABEL_IDX,
+                    permutations, DO_PERMUTATIONS, normalization_function, UINT8_PIPELINE,
+                    CACHE_DIR, shuffle_buffer_size, DEVICE_PREFETCH_BUFFER,
+                    strategy, is_val=extract_features)
 
                 if DO_VALIDATION:
-                    val_metric_1 = tf.keras.metrics.BinaryAccuracy(threshold=ACCURACY_THRESHOLD, name='val_BA')
-                    val_metric_2 = tfa.metrics.F1Score(
-                        num_classes=NUM_CLASSES, average=F1_SCORE_AVERAGE, 
-                        threshold=F1_SCORE_THRESHOLD, name='val_F1')
-                    val_metrics = [val_metric_1, val_metric_2]
-
+                    val_dataset = prepareStreamingDataset(
+                        batch_size, NUM_CLASSES,
+                        val_split_paths,
+                        METADATA, ID_COLUMN, TARGET_FEATURE_COLUMNS,
+                        FILENAME_UNDERSCORE, CREATE_ONEHOT, CREATE_SPARSE, LABEL_IDX,
+                        None, DO_PERMUTATIONS, normalization_function, UINT8_PIPELINE,
+                        CACHE_DIR, shuffle_buffer_size, DEVICE_PREFETCH_BUFFER,
+                        strategy, is_val=True)
                 else:
-                    val_metrics = None
+                    val_dataset = None
+
+            # image batches that int8 activation ranges are calibrated on, taken before they are replaced by features
+            calibration_dataset = val_dataset if DO_VALIDATION else train_dataset
+
+            if extract_features:
+
+                # every sample is passed through the body once, without permutations
+                train_dataset = prepareFeatureDataset(
+                    train_dataset, body_model, normalization_function, UINT8_PIPELINE, 
+                    batch_size, CACHE_DIR, shuffle_buffer_size, DEVICE_PREFETCH_BUFFER, 
+                    strategy, is_val=False)
 
-                # rename optimizer weights to train multiple models
-                with K.name_scope(optimizer.__class__.__name__):
-                    for i, var in enumerate(optimizer.weights):
-                        name = 'variable{}'.format(i)
-                        optimizer.weights[i] = tf.Variable(
-                            var, name=name)
+                if DO_VALIDATION:
+                    val_dataset = prepareFeatureDataset(
+                        val_dataset, body_model, normalization_function, UINT8_PIPELINE, 
+                        batch_size, CACHE_DIR, shuffle_buffer_size, DEVICE_PREFETCH_BUFFER, 
+                        strategy, is_val=True)
 
             classificationCustomTrain(
-                NUM_EPOCHS, START_EPOCH, batch_size, NUM_CLASSES, NUM_ADD_CLASSES, 
-                train_paths_list, val_paths_list, DO_VALIDATION, max_fileparts_train, max_fileparts_val, None,
-                METADATA, ID_COLUMN, TARGET_FEATURE_COLUMNS, ADD_FEATURES_COLUMNS, 
-                FILENAME_UNDERSCORE, CREATE_ONEHOT, CREATE_SPARSE, LABEL_IDX, LABEL_IDXS_ADD,  
-                PERMUTATIONS_CLASSIFICATION, DO_PERMUTATIONS, normalization_function,
-                model_name, model,
+                NUM_EPOCHS, START_EPOCH,
+                train_dataset, val_dataset, DO_VALIDATION, fold,
+                wrapperTrain, wrapperVal, trainPreprocessing, valPreprocessing, accumulated_gradients,
+                model_name, model, head_model, train_model,
                 loss_object, val_loss, compute_total_loss,
+                grad_accum_steps,
                 CUSTOM_LRS_EPOCHS,
-                LR_LADDER, LR_LADDER_STEP, LR_LADDER_EPOCHS, 
+                LR_LADDER, LR_LADDER_STEP, LR_LADDER_EPOCHS,
                 REDUCE_LR_PLATEAU, REDUCE_LR_PATIENCE, REDUCE_LR_FACTOR, REDUCE_LR_MINIMAL_LR, REDUCE_LR_METRIC,
                 optimizer,
                 METRIC_TYPE, train_metrics, val_metrics,
@@ -437,26 +493,62 @@ def classificationCustom():
 
             print('________________________________________')
             print('\n')
-            print('TRAINING FINISHED FOR ' + model_name + '!')
+            if DO_KFOLD:
+                print('TRAINING FINISHED FOR ' + model_name + ', fold ' + str(fold + 1) + '/' + str(NUM_FOLDS) + ' !')
+            else:
+                print('TRAINING FINISHED FOR ' + model_name + '!')
             print('\n')
             print('________________________________________')
 
-            del train_paths_list
-            del val_paths_list
-            del max_fileparts_train
-            del max_fileparts_val
-            del model
-            del loss_object
-            del val_loss
-            del optimizer
-            del train_metrics
-            del val_metrics
-
-            K.clear_session()
-
-            # sleep 120 seconds
-            print('Sleeping 120 seconds after training ' + model_name + '. Zzz...')
-            time.sleep(120)
-
-        del batch_size_per_replica
-        del batch_size
+            # models with additional inputs (features, ArcFace labels) are not exported
+            if EXPORT_TFLITE and not (LOAD_FEATURES or BUILD_ARC):
+
+                if UINT8_PIPELINE:
+                    def calibrationPreprocessing(data):
+                        return preprocessBatch(data, None, DO_PERMUTATIONS, normalization_function, is_val=True)
+                else:
+                    calibrationPreprocessing = None
+
+                saveTFLiteModel(
+                    model, model_name, fold, 
+                    calibration_dataset, NUM_CALIBRATION_BATCHES, calibrationPreprocessing, 
+                    strategy, SAVE_TRAIN_WEIGHTS_DIR)
+
+            # datasets keep batches prefetched on every GPU, they are released before the next fold builds its own
+            del train_dataset, val_dataset, calibration_dataset
+
+        # names are rebound only after the next model is built, so the models and optimizer
+        # holding GPU memory are released here, everything else is freed by clear_session and gc
+        del model, body_model, head_model, train_model, optimizer
+
+        # free GPU memory before the next model is built
+        K.clear_session()
+        gc.collect()
+        for gpu in tf.config.list_logical_devices('GPU'):
+            tf.config.experimental.reset_memory_stats(gpu.name)
+
+        if COOLDOWN_SECONDS:
+            print('Sleeping ' + str(COOLDOWN_SECONDS) + ' seconds after training ' + model_name + '. Zzz...')
+            time.sleep(COOLDOWN_SECONDS)
+
+
+if __name__ == '__main__':
+
+    # runtime options are set only when training is started, importing this file has no side effects on TensorFlow
+    # both have to be set before TensorFlow runtime is initialized
+    tf.config.threading.set_inter_op_parallelism_threads(
+        NUM_CPU_THREADS if NUM_CPU_THREADS is not None else os.cpu_count())
+
+    gpus = tf.config.experimental.list_physical_devices('GPU')
+    for gpu in gpus:
+        tf.config.experimental.set_memory_growth(gpu, True)
+
+    # has to be set before any model is built, output layers stay in float32
+    mixed_precision_policy = getMixedPrecisionPolicy(MIXED_PRECISION_POLICY)
+    if mixed_precision_policy is not None:
+        tf.keras.mixed_precision.set_global_policy(mixed_precision_policy)
+
+    # all visible GPUs are used
+    strategy = tf.distribute.MirroredStrategy(cross_device_ops=getCrossDeviceOps(CROSS_DEVICE_OPS))
+
+    classificationCustom(strategy)
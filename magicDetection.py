@@ -1,6 +1,6 @@
 from train import detectionTrain
 from globalVariables import (BATCH_SIZE_DETECTION, NUM_EPOCHS_DETECTION, NUM_CLASSES_DETECTION, DUMMY_SHAPE_DETECTION,
-                            TRAIN_FILEPATHS_DETECTION, TRAIN_META_DETECTION, BBOX_FORMAT, LABEL_ID_OFFSET,
+                            TRAIN_FILEPATHS_DETECTION, getTrainMetaDetection, BBOX_FORMAT, LABEL_ID_OFFSET,
                             PERMUTATIONS_DETECTION, LEARNING_RATE, LR_DECAY_STEPS, LR_DECAY_RATE, MODEL_NAME_DETECTION,
                             CONFIG_PATH, CHECKPOINT_PATH, SAVE_CHECKPOINT_DIR, SAVE_TRAIN_INFO_DIR_DETECTION)
 
@@ -76,7 +76,7 @@ def detection():
     detectionTrain(
         NUM_EPOCHS_DETECTION, BATCH_SIZE_DETECTION, 
         NUM_CLASSES_DETECTION, LABEL_ID_OFFSET,
-        TRAIN_FILEPATHS_DETECTION, BBOX_FORMAT, TRAIN_META_DETECTION, 
+        TRAIN_FILEPATHS_DETECTION, BBOX_FORMAT, getTrainMetaDetection(), 
         PERMUTATIONS_DETECTION, None,
         detection_model, MODEL_NAME_DETECTION, 
         optimizer, to_fine_tune,
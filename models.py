@@ -1,14 +1,13 @@
+import os
+
 import tensorflow as tf
-import tfimm
-from object_detection.utils import config_util
-from object_detection.builders import model_builder
 from keras.applications import *
 from keras import Sequential
 from keras.layers import *
 from keras.models import load_model
 
 from globalVariables import DROPOUT_RATES, FC_LAYERS
-from layers import ArcMarginProduct
+from layers import ArcMarginProduct, MultiGlobalAveragePooling
 
 
 MODELS_CLASSIFICATION = {
@@ -123,17 +122,8 @@ def unfreezeModel(model, num_input_layers, batch_norm, num_layers, unfreeze_batc
 
     if FC_LAYERS != None:
 
-        for layer in FC_LAYERS:
-
-            if layer != None:
-
-                num_last_layers += 1
-        
-        for layer in DROPOUT_RATES:
-
-            if layer != None:
-
-                num_last_layers += 1
+        num_last_layers += len([layer for layer in FC_LAYERS if layer != None])
+        num_last_layers += len([layer for layer in DROPOUT_RATES if layer != None])
         
     num_layers_unfreeze = num_layers + num_last_layers
 
@@ -191,13 +181,13 @@ def buildClassificationPretrainedModel(model_path, pretrained_model, custom_obje
     if load_model:
         pretrained_model = tf.keras.models.load_model(model_path, custom_objects)
 
-    model = tf.keras.models.Sequential()
-    # add all layers except last layer
-    for layer in pretrained_model.layers[:-1]:
-        model.add(layer)
+    # the graph is reused up to the input of the last layer, so skip connections are kept
+    features = pretrained_model.layers[-1].input
 
     # add last classification layer
-    model.add(tf.keras.layers.Dense(num_classes, activation=activation))
+    predictions = tf.keras.layers.Dense(num_classes, activation=activation, dtype='float32')(features)
+
+    model = tf.keras.Model(inputs=pretrained_model.inputs, outputs=predictions)
 
     return model
 
@@ -266,6 +256,10 @@ def buildClassificationImageNetModel(
         dropout_rates : tuple or None
             whether to include dropout layers between last fully connected layers and their rate
 
+        gap_idxs : list or None
+            indices of ImageNet model layers whose outputs are globally average pooled and concatenated
+            used only with pooling = 'avg', None pools only the last layer
+
         num_classes : int
             number of classes
 
@@ -298,8 +292,8 @@ def buildClassificationImageNetModel(
 
         if gap_idxs is not None:
 
-            gaps = tf.concat([tf.keras.layers.GlobalAveragePooling2D()(feature_extractor.layers[gap_idx].output) for gap_idx in gap_idxs], axis=1)
-            feature_extractor = feature_extractor(gaps)
+            gap_outputs = [imagenet_model.layers[gap_idx].output for gap_idx in gap_idxs]
+            feature_extractor = MultiGlobalAveragePooling(name='avg_global_pool')(gap_outputs)
 
         else:
             
@@ -332,33 +326,33 @@ def buildClassificationImageNetModel(
 
         concat_layer = None
 
-    if (fc_layers is not None) or (dropout_rates is not None):
+    # head layers are listed once the configuration is known and then applied in order
+    head_layers = []
 
-        for fc, dropout in zip(fc_layers, dropout_rates):
+    if fc_layers is not None:
 
-            if fc == None:
+        if dropout_rates is None:
+            dropout_rates = [None] * len(fc_layers)
 
-                continue
+        for fc, dropout in zip(fc_layers, dropout_rates):
 
-            else:
+            if fc is None:
 
-                if concat_layer is not None:
+                continue
 
-                    feature_extractor = tf.keras.layers.Dense(fc, activation='relu')(concat_layer)
+            head_layers.append(tf.keras.layers.Dense(fc, activation='relu'))
 
-                    concat_layer = None
+            if dropout is not None:
 
-                else:
+                head_layers.append(tf.keras.layers.Dropout(dropout))
 
-                    feature_extractor = tf.keras.layers.Dense(fc, activation='relu')(feature_extractor)
+    if concat_layer is not None:
 
-            if dropout == None:
+        feature_extractor = concat_layer
 
-                continue
+    for head_layer in head_layers:
 
-            else:
-
-                feature_extractor = tf.keras.layers.Dropout(dropout)(feature_extractor)
+        feature_extractor = head_layer(feature_extractor)
 
     if concat_features_after:
 
@@ -375,11 +369,11 @@ def buildClassificationImageNetModel(
 
         if concat_layer is not None:
 
-            predictions = tf.keras.layers.Dense(num_classes, activation=activation)(concat_layer)
+            predictions = tf.keras.layers.Dense(num_classes, activation=activation, dtype='float32')(concat_layer)
 
         else:
 
-            predictions = tf.keras.layers.Dense(num_classes, activation=activation)(feature_extractor)
+            predictions = tf.keras.layers.Dense(num_classes, activation=activation, dtype='float32')(feature_extractor)
 
         model = tf.keras.Model(inputs=inputs, outputs=predictions)
 
@@ -398,6 +392,46 @@ def buildClassificationImageNetModel(
         return model
 
 
+def splitFrozenModel(model, pooling):
+    """
+    splits a model built by buildClassificationImageNetModel into its frozen body and head layers
+    the body ends at the global pooling layer, the head is built from the same layer objects after it,
+    so both models share weights with the given model
+    works only for models without additional input features
+
+    parameters
+    ----------
+        model : object
+            model built by buildClassificationImageNetModel
+
+        pooling : string
+            either 'avg' or 'max', pooling used to build the model
+
+    returns
+    -------
+        body_model : object
+            model from the model inputs to the global pooling outputs
+
+        head_model : object
+            model from the global pooling outputs to the model outputs
+    """
+
+    pooling_layer = model.get_layer(pooling + '_global_pool')
+
+    body_model = tf.keras.Model(inputs=model.inputs, outputs=pooling_layer.output)
+
+    head_input = tf.keras.layers.Input(shape=pooling_layer.output.shape[1:], name='input_body_features_layer')
+    head_output = head_input
+
+    for layer in model.layers[model.layers.index(pooling_layer) + 1:]:
+
+        head_output = layer(head_output)
+
+    head_model = tf.keras.Model(inputs=head_input, outputs=head_output)
+
+    return body_model, head_model
+
+
 def buildDetectionModel(num_classes, checkpoint_path, config_path, dummy_shape):
     """
     builds an object localization/classification model from Object Detection API library and loads weights
@@ -433,6 +467,10 @@ def buildDetectionModel(num_classes, checkpoint_path, config_path, dummy_shape):
     # tar -xf efficientdet_d4_1024x1024.tar.gz
     # mv efficientdet_d4_coco17_tpu-32/checkpoint models/research/object_detection/test_data/
 
+    # imported here so that classification doesn't load the object detection API
+    from object_detection.utils import config_util
+    from object_detection.builders import model_builder
+
     configs = config_util.get_configs_from_pipeline_file(
         config_path, config_override=None)
 
@@ -502,7 +540,9 @@ def buildDenoisingAutoencoder(
 
     for idx, (features, activation) in enumerate(predictions_features):
 
-        prediction_layer = tf.keras.layers.Dense(features, activation=activation, name=('prediction_layer_' + idx))(dense_decoder_layer)
+        # outputs stay in float32 under a mixed precision policy
+        prediction_layer = tf.keras.layers.Dense(
+            features, activation=activation, name=('prediction_layer_' + idx), dtype='float32')(dense_decoder_layer)
 
         prediction_layers.append(prediction_layer)
 
@@ -535,20 +575,22 @@ def buildTFIMM(
     fc_layers, num_classes, output_activation, 
     load_model, classification_checkpoint):
 
-    if load_model:
+    # imported here so that its model registry is only loaded when tfimm models are used
+    import tfimm
 
-        model = load_model(classification_checkpoint)
+    backbone = tfimm.create_model(model_name, nb_classes=0, pretrained="timm")
+    backbone_input = backbone(inputs[0])
 
-    else:
+    classifier_concat = tf.keras.layers.Concatenate()([inputs[1], backbone_input])
+    classifier_dense = tf.keras.layers.Dense(units=fc_layers[0], activation='relu')(classifier_concat)
+    classifier_prediction = tf.keras.layers.Dense(units=num_classes, activation=output_activation, dtype='float32')(classifier_dense)
 
-        backbone = tfimm.create_model(model_name, nb_classes=0, pretrained="timm")
-        backbone_input = backbone(inputs[0])
+    model = tf.keras.Model(inputs=[inputs], outputs=classifier_prediction)
 
-        classifier_concat = tf.keras.layers.Concatenate()([inputs[1], backbone_input])
-        classifier_dense = tf.keras.layers.Dense(units=fc_layers[0], activation='relu')(classifier_concat)
-        classifier_prediction = tf.keras.layers.Dense(units=num_classes, activation=output_activation)(classifier_dense)
+    # the load_model argument shadows keras load_model, weights of the saved model are restored instead
+    if load_model:
 
-        model = tf.keras.Model(inputs=[inputs], outputs=classifier_prediction)
+        model.load_weights(os.path.join(classification_checkpoint, 'variables', 'variables')).expect_partial()
 
     normalization_function = tfimm.create_preprocessing(model_name, dtype="float32") 
 
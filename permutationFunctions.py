@@ -1,5 +1,6 @@
 import random
 
+import cv2
 import numpy as np
 import albumentations as A
 
@@ -194,6 +195,179 @@ def applyRotateImage(image, limit, p):
     return image
 
 
+class RandomGammaLUT(A.ImageOnlyTransform):
+    """
+    random gamma correction through a 256-entry lookup table, same parameters as A.RandomGamma
+    gamma is sampled once per image and applied with cv2.LUT instead of a per-pixel power
+
+    parameters
+    ----------
+        gamma_limit : tuple
+            gamma range in percent
+            taken from globalVariables.py
+
+        p : float
+            probability to apply gamma correction
+            taken from globalVariables.py
+    """
+
+    def __init__(self, gamma_limit=(80, 120), always_apply=False, p=0.5):
+        super(RandomGammaLUT, self).__init__(always_apply=always_apply, p=p)
+        self.gamma_limit = gamma_limit
+
+    def get_params(self):
+        return {'gamma': random.uniform(self.gamma_limit[0], self.gamma_limit[1]) / 100.0}
+
+    def apply(self, img, gamma=1.0, **params):
+        if img.dtype != np.uint8:
+            img = np.clip(img, 0, 255).astype(np.uint8)
+
+        lut = np.clip(np.power(np.arange(256, dtype=np.float32) / 255.0, gamma) * 255.0, 0, 255).astype(np.uint8)
+
+        return cv2.LUT(img, lut)
+
+    def get_transform_init_args_names(self):
+        return ('gamma_limit', )
+
+
+class FusedColorGeom(A.ImageOnlyTransform):
+    """
+    applies saturation shift, sharpen, emboss, brightness/contrast, gamma and horizontal flip in a single pass
+
+    each effect is sampled with its own probability p, the same way as the separate albumentations transforms.
+    sharpen and emboss are merged into one 3x3 kernel, brightness/contrast and gamma into one 256-entry lookup table,
+    so the image is converted to HSV once, filtered once and looked up once instead of being copied by every transform
+
+    parameters
+    ----------
+        gamma_limit : tuple
+            gamma range in percent, same as A.RandomGamma
+            taken from globalVariables.py
+
+        sharpen_alpha : tuple
+            visibility range of the sharpened image, same as A.Sharpen
+            taken from globalVariables.py
+
+        sharpen_lightness : tuple
+            lightness range of the sharpened image, same as A.Sharpen
+            taken from globalVariables.py
+
+        emboss_alpha : tuple
+            visibility range of the embossed image, same as A.Emboss
+
+        emboss_strength : tuple
+            strength range of the embossing, same as A.Emboss
+            taken from globalVariables.py
+
+        brightness_limit : float
+            brightness shift range, same as A.RandomBrightnessContrast
+            taken from globalVariables.py
+
+        contrast_limit : float
+            contrast shift range, same as A.RandomBrightnessContrast
+            taken from globalVariables.py
+
+        sat_shift_limit : list
+            saturation shift range, same as A.HueSaturationValue
+            taken from globalVariables.py
+
+        do_flip : bool
+            whether to include horizontal flip
+
+        p : float
+            probability to apply each of the effects
+            taken from globalVariables.py
+    """
+
+    def __init__(self, gamma_limit=(80, 120), sharpen_alpha=(0.2, 0.5), sharpen_lightness=(0.5, 1.0),
+                 emboss_alpha=(0.2, 0.5), emboss_strength=(0.2, 0.7), brightness_limit=0.2, contrast_limit=0.2,
+                 sat_shift_limit=(-30, 30), do_flip=True, always_apply=False, p=0.5):
+        # effects are gated individually inside get_params, so the transform itself always runs
+        super(FusedColorGeom, self).__init__(always_apply=True, p=1.0)
+        self.gamma_limit = gamma_limit
+        self.sharpen_alpha = sharpen_alpha
+        self.sharpen_lightness = sharpen_lightness
+        self.emboss_alpha = emboss_alpha
+        self.emboss_strength = emboss_strength
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.sat_shift_limit = sat_shift_limit
+        self.do_flip = do_flip
+        self.effect_p = p
+        self.identity = np.array([[0, 0, 0], [0, 1, 0], [0, 0, 0]], dtype=np.float32)
+
+    def sharpenKernel(self, alpha, lightness):
+        effect = np.array([[-1, -1, -1], [-1, 8 + lightness, -1], [-1, -1, -1]], dtype=np.float32)
+
+        return alpha * (effect - self.identity)
+
+    def embossKernel(self, alpha, strength):
+        effect = np.array([[-1 - strength, -strength, 0], [-strength, 1, strength], [0, strength, 1 + strength]],
+                          dtype=np.float32)
+
+        return alpha * (effect - self.identity)
+
+    def get_params(self):
+        params = {'kernel': None, 'lut': None, 'sat_shift': None, 'flip': False}
+
+        kernel = self.identity.copy()
+        do_kernel = False
+        if random.random() < self.effect_p:
+            kernel += self.sharpenKernel(random.uniform(*self.sharpen_alpha), random.uniform(*self.sharpen_lightness))
+            do_kernel = True
+        if random.random() < self.effect_p:
+            kernel += self.embossKernel(random.uniform(*self.emboss_alpha), random.uniform(*self.emboss_strength))
+            do_kernel = True
+        if do_kernel:
+            params['kernel'] = kernel
+
+        # brightness/contrast and gamma are both pointwise, so they collapse into one lookup table
+        alpha, beta, gamma = 1.0, 0.0, 1.0
+        if random.random() < self.effect_p:
+            alpha = 1.0 + random.uniform(-self.contrast_limit, self.contrast_limit)
+            beta = random.uniform(-self.brightness_limit, self.brightness_limit)
+        if random.random() < self.effect_p:
+            gamma = random.uniform(self.gamma_limit[0], self.gamma_limit[1]) / 100.0
+        if alpha != 1.0 or beta != 0.0 or gamma != 1.0:
+            values = np.arange(256, dtype=np.float32)
+            values = np.clip(values * alpha + beta * 255.0, 0, 255)
+            values = np.power(values / 255.0, gamma) * 255.0
+            params['lut'] = np.clip(values, 0, 255).astype(np.uint8)
+
+        if random.random() < self.effect_p:
+            params['sat_shift'] = random.uniform(self.sat_shift_limit[0], self.sat_shift_limit[1])
+
+        if self.do_flip and random.random() < self.effect_p:
+            params['flip'] = True
+
+        return params
+
+    def apply(self, img, kernel=None, lut=None, sat_shift=None, flip=False, **params):
+        if img.dtype != np.uint8:
+            img = np.clip(img, 0, 255).astype(np.uint8)
+
+        if sat_shift is not None:
+            hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV).astype(np.int16)
+            np.add(hsv[..., 1], int(sat_shift), out=hsv[..., 1], casting='unsafe')
+            np.clip(hsv[..., 1], 0, 255, out=hsv[..., 1])
+            img = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2RGB)
+
+        if kernel is not None:
+            img = cv2.filter2D(img, -1, kernel)
+
+        if lut is not None:
+            img = cv2.LUT(img, lut)
+
+        if flip:
+            img = cv2.flip(img, 1)
+
+        return img
+
+    def get_transform_init_args_names(self):
+        return ('gamma_limit', 'sharpen_alpha', 'sharpen_lightness', 'emboss_alpha', 'emboss_strength',
+                'brightness_limit', 'contrast_limit', 'sat_shift_limit', 'do_flip')
+
+
 def classification_permutations(image, permutations):
     """
     returns a permutated image using a composition of permutations
@@ -203,8 +377,9 @@ def classification_permutations(image, permutations):
         image : np.array
             input image
 
-        permutations : list
+        permutations : list or albumentations transform
             list of function permutations
+            or a single transform, e.g. A.OneOf, that is applied as is
 
     returns
     -------
@@ -212,7 +387,11 @@ def classification_permutations(image, permutations):
             permutated image
     """
 
-    transformations = A.Compose([permutation for permutation in permutations])
+    if isinstance(permutations, list):
+        transformations = A.Compose([permutation for permutation in permutations])
+    else:
+        transformations = permutations
+
     transformed = transformations(image=image)
     image = transformed['image']
 
@@ -1,8 +1,13 @@
-from helpers import evaluateString, getLabelFromPath, getFeaturesFromPath, loadNumpy, createOneHotVector, createSparseValue
+from helpers import evaluateString, getLabelFromPath, getFeaturesFromPath, loadNumpy, getNumpyHeader, createOneHotVector, createSparseValue, createSparseValueTensor
 from permutationFunctions import classification_permutations, detection_permutations, whiteNoise, bandpassNoise
 from preprocessFunctions import randomMelspecPower, spectrogramToDecibels, normalizeSpectogram, melspecMonoToColor
 from globalVariables import BANDPASS_NOISE_PROBABILITY, INPUT_SHAPE, NOISE_LEVEL, WHITE_NOISE_PROBABILITY, SIGNAL_AMPLIFICATION
 
+import os
+import glob
+import math
+import hashlib
+import mmap
 import librosa
 import numpy as np
 import random
@@ -61,16 +66,174 @@ def preprocessData(
 
     else:
         if not is_val:
-            if do_permutations:
+            if do_permutations and not isinstance(permutations, tf.keras.layers.Layer):
                 data = classification_permutations(data, permutations)
 
-        data = normalization(data)
+        if normalization is not None:
+            data = normalization(data)
 
         data_tensor = tf.convert_to_tensor(data)
 
         return data_tensor
 
 
+def preprocessBatch(data, permutations, do_permutations, normalization, is_val):
+    """
+    batched counterpart of preprocessData for classification tasks
+    applies batched permutations (tf.keras layers) and a normalization function to a whole batch at once,
+    so that it runs as a single graph op per batch instead of a Python call per image
+    either mapped over the tf.data pipeline or called inside the training step on GPU when the pipeline is uint8
+
+    parameters
+    ----------
+        data : tensor or tuple
+            batch of data of shape (batch, height, width, channels), uint8 or float32
+            or a tuple of such batch and batches of additional features
+
+        permutations : tf.keras.layers.Layer or list
+            batched permutation layer
+            lists of albumentations permutations are applied per image in preprocessData instead
+
+        do_permutations : boolean
+            either to perform data permutations or not
+
+        normalization : function
+            normalization function
+
+        is_val : boolean
+            True if it is the validation stage
+
+    returns
+    -------
+        data : tensor
+            float32 preprocessed batch of data
+    """
+
+    if isinstance(data, tuple):
+        # additional features are passed through untouched
+        data_preprocessed = preprocessBatch(data[0], permutations, do_permutations, normalization, is_val)
+        return (data_preprocessed,) + data[1:]
+
+    data = tf.cast(data, tf.float32)
+
+    if (not is_val) and do_permutations and isinstance(permutations, tf.keras.layers.Layer):
+        data = permutations(data, training=True)
+
+    if normalization is not None:
+        data = normalization(data)
+
+    return data
+
+
+def permuteDataset(data_dataset, permutations):
+    """
+    applies albumentations permutations per image as a separate parallel tf.data stage
+    every image is permuted in its own tf.numpy_function call, so tf.data runs as many of them at once
+    as there are free CPU threads, and loading and permuting are scheduled independently
+
+    parameters
+    ----------
+        data_dataset : tf.data.Dataset
+            unbatched dataset of (data, label) pairs, data is uint8 or float32 of shape INPUT_SHAPE
+
+        permutations : list or albumentations transform
+            albumentations permutations (a list or a single transform)
+
+    returns
+    -------
+        data_dataset : tf.data.Dataset
+            dataset with permuted data of the same dtype and shape
+    """
+
+    def permuteSample(data):
+
+        data_dtype = data.dtype
+        data = classification_permutations(data, permutations)
+
+        if data_dtype == np.uint8:
+            return np.clip(data, 0, 255).astype(np.uint8)
+
+        return data.astype(np.float32)
+
+    def permuteSampleTensor(data, label):
+
+        data_permuted = tf.numpy_function(permuteSample, [data], data.dtype)
+        data_permuted.set_shape(INPUT_SHAPE)
+
+        return data_permuted, label
+
+    return data_dataset.map(permuteSampleTensor, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+
+
+def augmentBIRDCLEFDataset(data_dataset, group_size, create_sparse, uint8_pipeline):
+    """
+    applies random augmentations and mixing of loadBIRDCLEFSample to melspectograms read from shards
+    as a separate parallel tf.data stage, so that samples are augmented anew every epoch
+    consecutive samples are grouped, and every sample is mixed with the next samples of its group,
+    so melspectograms to mix in are already read and no other files are loaded
+
+    parameters
+    ----------
+        data_dataset : tf.data.Dataset
+            unbatched and shuffled dataset of (data, label) pairs, data is a float32 melspectogram as it is stored in a .npy file
+
+        group_size : integer
+            number of samples mixed with each other
+
+        create_sparse : boolean
+            whether labels are sparse class indices, which are never mixed, or one-hot labels
+
+        uint8_pipeline : boolean
+            whether to return data as uint8 instead of float32
+
+    returns
+    -------
+        data_dataset : tf.data.Dataset
+            unbatched dataset of augmented color images of shape INPUT_SHAPE with values in [0, 255]
+    """
+
+    def augmentGroup(data, labels):
+
+        num_samples = len(data)
+        data_augmented = []
+        labels_augmented = []
+
+        for sample in range(num_samples):
+
+            # a sparse label can hold a single class, and a last group may have too few samples to mix in
+            if create_sparse:
+                num_mixes = 0
+            else:
+                num_mixes = min(getBIRDCLEFNumMixes(), num_samples - 1)
+            mix_samples = [(sample + shift) % num_samples for shift in range(1, num_mixes + 1)]
+
+            sample_data, sample_label = augmentBIRDCLEFSample(
+                data[sample], labels[sample].copy(), 
+                [data[mix_sample] for mix_sample in mix_samples], [labels[mix_sample] for mix_sample in mix_samples])
+
+            if uint8_pipeline:
+                sample_data = np.clip(sample_data, 0, 255).astype(np.uint8)
+
+            data_augmented.append(sample_data)
+            labels_augmented.append(sample_label.astype(labels.dtype))
+
+        return np.stack(data_augmented), np.stack(labels_augmented)
+
+    def augmentGroupTensor(data, labels):
+
+        data_dtype = tf.uint8 if uint8_pipeline else tf.float32
+        data_augmented, labels_augmented = tf.numpy_function(augmentGroup, [data, labels], [data_dtype, labels.dtype])
+        data_augmented.set_shape((None, ) + tuple(INPUT_SHAPE))
+        labels_augmented.set_shape(labels.shape)
+
+        return data_augmented, labels_augmented
+
+    data_dataset = data_dataset.batch(group_size)
+    data_dataset = data_dataset.map(augmentGroupTensor, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+
+    return data_dataset.unbatch()
+
+
 def prepareClassificationDataset(
     batch_size, num_classes, num_add_classes, 
     filepaths, filepaths_part, 
@@ -265,6 +428,259 @@ def prepareClassificationDataset(
     return data_dataset_dist
 
 
+def getBIRDCLEFLabel(
+    path, num_classes, 
+    meta, id_column, feature_column, 
+    filename_underscore, create_onehot, create_sparse, label_idx):
+    """
+    creates a target label of a single file for BIRDCLEF competition
+    either from its filename or from metadata
+
+    parameters
+    ----------
+
+        path : string
+            full path to the file
+
+        num_classes : integer
+            number of classes
+
+        meta : dataframe
+            metadata, table containing ids of files, additional features and features to predict
+
+        id_column : string
+            name of the id column in the metadata
+
+        feature_column : string
+            name of the target feature column
+
+        filename_underscore : boolean
+            True if end of a filename has a class after an underscore
+
+        create_onehot : boolean
+            whether to use metadata and load one-hot vector from there
+            or create a new one using a name of the file
+
+        create_sparse : boolean
+            used to create sparse label
+
+        label_idx : int
+            which idx to use when splitting filename path by underscore to create one-hot vector
+
+    returns
+    -------
+
+        label : ndarray
+            float32 target label, int64 class index if create_sparse
+    """
+
+    if create_onehot:
+        label = createOneHotVector(path, label_idx, num_classes)
+
+    elif create_sparse:
+        label = createSparseValue(path, label_idx)
+    
+    else:
+        label = getFeaturesFromPath(path, meta, id_column, feature_column, filename_underscore)
+
+        if type(label) == int or type(label) == float:
+            label = np.array(label, dtype=np.int32)
+
+        else:
+
+            label = evaluateString(label)
+
+    if create_sparse:
+        label = np.array(label, dtype=np.int64)
+    else:
+        label = np.array(label, dtype=np.float32)
+
+    return label
+
+
+def loadBIRDCLEFSample(
+    path, data, label, filepaths, num_classes, 
+    meta, id_column, feature_column, 
+    filename_underscore, create_onehot, create_sparse, label_idx):
+    """
+    loads and preprocesses a single melspectogram for BIRDCLEF competition
+    the process is as follows:
+        - load melspectogram
+        - load target label with getBIRDCLEFLabel unless it is already given
+        - randomly pick one or two other melspectograms to mix in
+          (only for one-hot labels, a sparse label can hold a single class)
+        - apply random augmentations and mixing with augmentBIRDCLEFSample
+
+    parameters
+    ----------
+
+        path : string
+            full path to the file
+
+        data : ndarray
+            melspectogram that is already read from path
+            None to load it with loadNumpy
+
+        label : ndarray
+            target label that is already created with getBIRDCLEFLabel
+            None to create it here
+
+        filepaths : list or ndarray
+            full paths to all files, used to pick files to mix in
+
+        num_classes : integer
+            number of classes
+
+        meta : dataframe
+            metadata, table containing ids of files, additional features and features to predict
+
+        id_column : string
+            name of the id column in the metadata
+
+        feature_column : string
+            name of the target feature column
+
+        filename_underscore : boolean
+            True if end of a filename has a class after an underscore
+
+        create_onehot : boolean
+            whether to use metadata and load one-hot vector from there
+            or create a new one using a name of the file
+
+        create_sparse : boolean
+            used to create sparse label
+
+        label_idx : int
+            which idx to use when splitting filename path by underscore to create one-hot vector
+
+    returns
+    -------
+
+        data : ndarray
+            float32 color image of shape INPUT_SHAPE with values in [0, 255]
+
+        label : ndarray
+            float32 target label, int64 class index if create_sparse
+    """
+
+    if data is None:
+        data = loadNumpy(path)
+
+    if label is None:
+        label = getBIRDCLEFLabel(
+            path, num_classes, 
+            meta, id_column, feature_column, 
+            filename_underscore, create_onehot, create_sparse, label_idx)
+
+    # a sparse label can hold a single class, so other melspectograms are only mixed into one-hot labels
+    if create_sparse:
+
+        mix_idxs = []
+
+    else:
+
+        # paths are unique, so a split with fewer than three files can't provide two other files to mix in
+        num_mixes = min(getBIRDCLEFNumMixes(), len(filepaths) - 1)
+
+        mix_idxs = []
+        while len(mix_idxs) < num_mixes:
+            mix_idx = random.randint(0, len(filepaths) - 1)
+            if filepaths[mix_idx] != path and filepaths[mix_idx] not in [filepaths[idx] for idx in mix_idxs]:
+                mix_idxs.append(mix_idx)
+
+    mix_data = [loadNumpy(filepaths[mix_idx]) for mix_idx in mix_idxs]
+    mix_labels = [np.array(createOneHotVector(filepaths[mix_idx], label_idx, num_classes), dtype=np.float32) 
+                  for mix_idx in mix_idxs]
+
+    return augmentBIRDCLEFSample(data, label, mix_data, mix_labels)
+
+
+def getBIRDCLEFNumMixes():
+    """
+    draws how many other melspectograms are mixed into a sample for BIRDCLEF competition
+
+    returns
+    -------
+
+        num_mixes : integer
+            1 in 45.5% of cases (2 classes), 2 in 24.5% of cases (3 classes), 0 otherwise
+    """
+
+    r2 = random.random()
+    r3 = random.random()
+
+    if r2 < 0.7 and r3 > 0.35:  # 45.5% 2 classes
+        num_mixes = 1
+    elif r2 < 0.7 and r3 < 0.35:    # 24.5% 3 classes
+        num_mixes = 2
+    else:
+        num_mixes = 0
+
+    return num_mixes
+
+
+def augmentBIRDCLEFSample(data, label, mix_data, mix_labels):
+    """
+    applies random augmentations of loadBIRDCLEFSample to a melspectogram for BIRDCLEF competition
+    the process is as follows:
+        - apply random power and amplification
+        - mix in other melspectograms rolled in time, with their own random power and amplification,
+          and add their classes to the label
+        - convert to decibels, normalize, add white and bandpass noise
+        - convert to a color image
+
+    parameters
+    ----------
+
+        data : ndarray
+            melspectogram as it is stored in a .npy file
+
+        label : ndarray
+            target label created with getBIRDCLEFLabel
+
+        mix_data : list
+            melspectograms to mix in, empty not to mix
+
+        mix_labels : list
+            float32 one-hot labels of melspectograms in mix_data
+
+    returns
+    -------
+
+        data : ndarray
+            float32 color image of shape INPUT_SHAPE with values in [0, 255]
+
+        label : ndarray
+            target label with classes of mixed in melspectograms added
+    """
+
+    data = randomMelspecPower(np.array(data, dtype=np.float32), 3, 0.5)
+    data *= (random.random() * SIGNAL_AMPLIFICATION + 1)
+
+    for data_mix, data_mix_label in zip(mix_data, mix_labels):
+
+        data_mix = np.roll(data_mix, random.randint(int(INPUT_SHAPE[1] / 16), int(INPUT_SHAPE[1] / 2)), axis=1)
+        data_mix = randomMelspecPower(np.array(data_mix, dtype=np.float32), 3, 0.5)
+        data_mix *= (random.random() * SIGNAL_AMPLIFICATION + 1)
+        data += data_mix
+
+        data_mix_label_idx = np.argmax(data_mix_label)
+        if label[data_mix_label_idx] != 1:
+            label = label + data_mix_label
+
+    data = spectrogramToDecibels(data)
+    data = normalizeSpectogram(data)
+
+    data = whiteNoise(data, INPUT_SHAPE, NOISE_LEVEL, WHITE_NOISE_PROBABILITY)
+    data = bandpassNoise(data, INPUT_SHAPE, NOISE_LEVEL, BANDPASS_NOISE_PROBABILITY)
+
+    data = randomMelspecPower(data, 2, 0.7)
+
+    data = melspecMonoToColor(data, INPUT_SHAPE, None)
+
+    return data.astype(np.float32), label
+
+
 def prepareBIRDCLEFDataset(
     batch_size, num_classes, num_add_classes, 
     filepaths, filepaths_part, 
@@ -476,6 +892,856 @@ def prepareBIRDCLEFDataset(
 
 
 
+def distributeDataset(data_dataset, strategy, device_prefetch_buffer):
+    """
+    distributes a batched dataset across GPUs
+    with a single worker every batch is split between its GPUs, auto-sharding only applies to multi-worker strategies,
+    where input is sharded by elements unless the dataset already sets an auto-shard policy
+    batches are copied to every GPU ahead of time into a per-replica buffer,
+    so that host to device copies overlap with the previous training step instead of blocking it
+
+    parameters
+    ----------
+        data_dataset : tf.data.Dataset
+            batched dataset
+
+        strategy : tf.distribute object
+            TensorFlow API used in distributed training
+
+        device_prefetch_buffer : integer
+            number of batches every GPU keeps prefetched in its own memory
+            taken from globalVariables.py
+
+    returns
+    -------
+        data_dataset_dist : strategy.experimental_distribute_dataset object
+            distributed dataset
+    """
+
+    options = tf.data.Options()
+    options.experimental_optimization.map_and_batch_fusion = True
+    # batches are copied together by parallel threads instead of element by element
+    options.experimental_optimization.parallel_batch = True
+
+    # the policy only takes effect under multi-worker strategies, a single worker reads the whole dataset
+    # datasets built from paths or indices in memory are then sharded by elements,
+    # builders reading files set their own policy before distributing
+    if data_dataset.options().experimental_distribute.auto_shard_policy == tf.data.experimental.AutoShardPolicy.AUTO:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+
+    data_dataset = data_dataset.with_options(options)
+
+    input_options = tf.distribute.InputOptions(
+        experimental_fetch_to_device=True, 
+        experimental_per_replica_buffer_size=device_prefetch_buffer)
+
+    data_dataset_dist = strategy.experimental_distribute_dataset(
+        data_dataset, options=input_options)
+
+    return data_dataset_dist
+
+
+def prepareFeatureDataset(
+        data_dataset, body_model, normalization, uint8_pipeline, 
+        batch_size, cache_dir, shuffle_buffer_size, device_prefetch_buffer, 
+        strategy, is_val):
+    """
+    runs a frozen model body once over a distributed dataset and builds a distributed dataset of its outputs
+    features of every sample are computed a single time and streamed into a tf.data cache,
+    so that every training epoch only runs the head layers on them
+
+    parameters
+    ----------
+        data_dataset : strategy.experimental_distribute_dataset object
+            distributed dataset built with is_val = True (no permutations, no dropped samples)
+            its elements are (data, labels) without additional features
+
+        body_model : object
+            frozen model body, outputs of its global pooling layer are used as features
+
+        normalization : function
+            normalization function to apply to data
+
+        uint8_pipeline : boolean
+            if True, data_dataset yields uint8 data and normalization is applied here before the body
+
+        batch_size : integer
+            number of feature vectors in a batch
+
+        cache_dir : string
+            directory where features are cached on disk, None or '' keeps them in memory
+            features are computed again on every call, a cache left by a previous fold or run is overwritten
+
+        shuffle_buffer_size : integer
+            number of training feature vectors held in the shuffle buffer
+
+        device_prefetch_buffer : integer
+            number of batches every GPU keeps prefetched in its own memory
+            taken from globalVariables.py
+
+        strategy : tf.distribute object
+            TensorFlow API used in distributed training
+
+        is_val : boolean
+            True if it is the validation dataset
+
+    returns
+    -------
+        features_dataset_dist : strategy.experimental_distribute_dataset object
+            distributed dataset of (features, labels)
+    """
+
+    def replicaFeatures(inputs):
+        data, labels = inputs
+        if uint8_pipeline:
+            data = preprocessBatch(data, None, False, normalization, is_val=True)
+        return body_model(data, training=False), labels
+
+    @tf.function
+    def distributedFeatures(inputs):
+        return strategy.run(replicaFeatures, args=(inputs,))
+
+    def generateFeatures():
+        for inputs in data_dataset:
+            features, labels = distributedFeatures(inputs)
+            yield from zip(
+                strategy.experimental_local_results(features), strategy.experimental_local_results(labels))
+
+    # shapes and dtypes of batches are taken from the first one, the batch dimension is left unknown
+    first_features, first_labels = next(generateFeatures())
+    output_signature = tuple(
+        tf.TensorSpec(shape=[None] + tensor.shape[1:].as_list(), dtype=tensor.dtype) for tensor in (first_features, first_labels))
+
+    features_dataset = tf.data.Dataset.from_generator(generateFeatures, output_signature=output_signature)
+    features_dataset = features_dataset.unbatch()
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, 'features_' + ('val' if is_val else 'train'))
+        # features cached by a previous fold or run come from other weights or samples
+        for path in glob.glob(cache_path + '*'):
+            os.remove(path)
+    else:
+        cache_path = ''
+
+    features_dataset = features_dataset.cache(cache_path)
+
+    # the body runs over the whole split here, batch by batch, so that training epochs only read the cache
+    for _ in features_dataset.batch(batch_size):
+        pass
+
+    if not is_val:
+        features_dataset = features_dataset.shuffle(shuffle_buffer_size, reshuffle_each_iteration=True)
+
+    features_dataset = features_dataset.batch(batch_size, drop_remainder=(not is_val))
+    features_dataset = features_dataset.prefetch(tf.data.AUTOTUNE)
+
+    features_dataset_dist = distributeDataset(features_dataset, strategy, device_prefetch_buffer)
+
+    return features_dataset_dist
+
+
+def prepareStreamingDataset(
+    batch_size, num_classes, 
+    filepaths, 
+    meta, id_column, feature_columns, 
+    filename_underscore, create_onehot, create_sparse, label_idx,  
+    permutations, do_permutations, normalization, uint8_pipeline, 
+    cache_dir, shuffle_buffer_size, device_prefetch_buffer, 
+    strategy, is_val):
+    """
+    prepares a streaming tf.data pipeline for BIRDCLEF competition
+    unlike prepareBIRDCLEFDataset it doesn't load all files into memory before training,
+    files are loaded by parallel workers while the model trains on previous batches:
+        - create a tf.data.Dataset.from_tensor_slices object from file paths and labels
+          (sparse labels are parsed from file paths in-graph, other labels are created once with getBIRDCLEFLabel)
+        - read every .npy file with tf.io.read_file and decode it in-graph using a header parsed once,
+          in a parallel non-deterministic map (every element is a single file, so there is nothing to interleave,
+          interleaved reads are only used for TFRecord shards in prepareTFRecordDataset)
+        - if cache_dir is given, cache decoded melspectograms (in memory or on disk), so that files are read 
+          and decoded only in the first epoch, and shuffle them in a buffer of shuffle_buffer_size samples,
+          otherwise shuffle paths before reading them
+          (either way training data is reshuffled every time the dataset is iterated, i.e. every epoch)
+        - map decoded melspectograms to loadBIRDCLEFSample calls wrapped in tf.numpy_function, running in parallel
+        - optionally apply albumentations permutations per image in a separate parallel map (permuteDataset)
+        - batch Dataset object
+        - map batches to the preprocessBatch function to apply batched permutations and normalize them
+          (if uint8_pipeline = True, data is kept as uint8 and this is done inside the training step on GPU)
+        - prefetch batches so that loading overlaps with training
+        - distribute it across GPUs with distributeDataset, copying batches to GPUs ahead of the training step
+    
+    the dataset is built once and iterated every epoch
+
+    parameters
+    ----------
+
+        batch_size : integer
+            number of training examples in one batch of data
+
+        num_classes : integer
+            number of classes
+
+        filepaths : list or ndarray
+            full paths to files
+
+        meta : dataframe
+            metadata, table containing ids of files, additional features and features to predict
+
+        id_column : string
+            name of the id column in the metadata
+
+        feature_columns : list
+            names of target feature columns
+
+        filename_underscore : boolean
+            True if end of a filename has a class after an underscore
+
+        create_onehot : boolean
+            whether to use metadata and load one-hot vector from there
+            or create a new one using a name of the file
+
+        create_sparse : boolean
+            used to create sparse label
+        
+        label_idx : int
+            which idx to use when splitting filename path by underscore to create one-hot vector
+
+        permutations : list or tf.keras.layers.Layer
+            albumentations permutations (a list or a single transform) applied per image
+            or a batched permutation layer applied to whole batches
+
+        do_permutations : boolen
+            either to perfrom data permutations or not
+
+        normalization : function
+            normalization function to apply to data
+
+        uint8_pipeline : boolean
+            whether to keep data as uint8 and leave batched permutations and normalization to the training step
+
+        cache_dir : string
+            directory where to cache decoded melspectograms, '' to cache them in memory, None not to cache
+
+        shuffle_buffer_size : integer
+            number of cached melspectograms held in the shuffle buffer of training data
+            the number of files shuffles the whole dataset every epoch
+
+        device_prefetch_buffer : integer
+            number of batches every GPU keeps prefetched in its own memory
+
+        strategy : tf.distribute object
+            TensorFlow API used in distributed training
+
+        is_val : boolean
+            shows whether it is a validation or training iteration
+
+    returns
+    -------
+
+        data_dataset_dist : strategy.experimental_distribute_dataset object
+            streaming, preprocessed, and batched data
+    """
+
+    filepaths = np.asarray(filepaths)
+
+    # all melspectograms share dtype and shape, so the .npy header is parsed once
+    # files are then read and decoded by tf.data worker threads without holding the GIL
+    header_length, numpy_dtype, numpy_shape = getNumpyHeader(filepaths[0])
+
+    def readNumpy(path):
+
+        # .npy headers are padded to a multiple of 64 bytes, so they can be dropped after decoding
+        data = tf.io.decode_raw(tf.io.read_file(path), tf.as_dtype(numpy_dtype))
+        data = data[header_length // numpy_dtype.itemsize:]
+
+        return tf.reshape(data, numpy_shape)
+
+    def loadSample(path, data, label):
+
+        path = path.decode('utf-8')
+
+        data, label = loadBIRDCLEFSample(
+            path, data, label, filepaths, num_classes, 
+            meta, id_column, feature_columns[-1], 
+            filename_underscore, create_onehot, create_sparse, label_idx)
+
+        if uint8_pipeline:
+            data = np.clip(data, 0, 255).astype(np.uint8)
+
+        return data, label
+
+    def loadSampleTensor(path, data, label):
+
+        data_dtype = tf.uint8 if uint8_pipeline else tf.float32
+        label_dtype = tf.int64 if create_sparse else tf.float32
+        data, label = tf.numpy_function(loadSample, [path, data, label], [data_dtype, label_dtype])
+        data.set_shape(INPUT_SHAPE)
+        if create_onehot:
+            label.set_shape((num_classes, ))
+        elif create_sparse:
+            label.set_shape(())
+
+        return data, label
+
+    # sparse labels are parsed from filenames in-graph by tf.data workers,
+    # other labels are created once and carried through the pipeline next to the paths
+    if create_sparse:
+
+        data_dataset = tf.data.Dataset.from_tensor_slices(filepaths)
+
+        def readSample(path):
+            return path, readNumpy(path), createSparseValueTensor(path, label_idx)
+
+    else:
+
+        labels = np.stack([
+            getBIRDCLEFLabel(
+                path, num_classes, 
+                meta, id_column, feature_columns[-1], 
+                filename_underscore, create_onehot, create_sparse, label_idx) 
+            for path in filepaths])
+
+        data_dataset = tf.data.Dataset.from_tensor_slices((filepaths, labels))
+
+        def readSample(path, label):
+            return path, readNumpy(path), label
+
+    # decoded melspectograms are the same every epoch, random power, mixing and noise are applied after the cache
+    # the cache replays the order it was written in, so it comes before any shuffling 
+    # and cached samples are reshuffled every epoch in a buffer
+    if cache_dir is not None:
+
+        data_dataset = data_dataset.map(
+            readSample, 
+            num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+
+        if cache_dir != '':
+            os.makedirs(cache_dir, exist_ok=True)
+            filepaths_hash = hashlib.md5('\n'.join(str(path) for path in filepaths).encode('utf-8')).hexdigest()[:8]
+            cache_dir = os.path.join(cache_dir, 'streaming_' + filepaths_hash)
+        data_dataset = data_dataset.cache(cache_dir)
+
+        if not is_val:
+            data_dataset = data_dataset.shuffle(shuffle_buffer_size, reshuffle_each_iteration=True)
+
+    else:
+
+        # paths are cheap to hold, so all of them are shuffled before reading
+        if not is_val:
+            data_dataset = data_dataset.shuffle(len(filepaths), reshuffle_each_iteration=True)
+
+        data_dataset = data_dataset.map(
+            readSample, 
+            num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+
+    data_dataset = data_dataset.map(
+        loadSampleTensor, 
+        num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+
+    if (not is_val) and do_permutations and not isinstance(permutations, tf.keras.layers.Layer):
+        data_dataset = permuteDataset(data_dataset, permutations)
+
+    # a partial last training batch would change the shapes of the compiled training step
+    data_dataset = data_dataset.batch(batch_size, drop_remainder=(not is_val))
+
+    if not uint8_pipeline:
+        data_dataset = data_dataset.map(
+            lambda data, labels: (preprocessBatch(data, permutations, do_permutations, normalization, is_val), labels),
+            num_parallel_calls=tf.data.AUTOTUNE)
+
+    data_dataset = data_dataset.prefetch(tf.data.AUTOTUNE)
+
+    data_dataset_dist = distributeDataset(data_dataset, strategy, device_prefetch_buffer)
+
+    return data_dataset_dist
+
+
+def getShardPaths(filepaths, save_dir, prefix, max_files_per_part, extension):
+    """
+    creates full paths of shards that filepaths are converted into
+    filenames contain a hash of filepaths, so shards written for a different list of files are never reused
+
+    parameters
+    ----------
+
+        filepaths : list or ndarray
+            full paths to numpy files
+
+        save_dir : string
+            full path to directory where shards are saved
+
+        prefix : string
+            name of the split, used as a prefix of shard filenames
+
+        max_files_per_part : integer
+            maximum number of files in one shard
+
+        extension : string
+            file extension of shards
+
+    returns
+    -------
+
+        shard_paths : list
+            full paths to shards
+    """
+
+    filepaths_hash = hashlib.md5('\n'.join(str(path) for path in filepaths).encode('utf-8')).hexdigest()[:8]
+
+    num_shards = max(1, math.ceil(len(filepaths) / max_files_per_part))
+    shard_paths = [os.path.join(save_dir, prefix + '_' + filepaths_hash + '_' + str(shard) + '-of-' + str(num_shards) + extension) 
+                   for shard in range(num_shards)]
+
+    return shard_paths
+
+
+def writeTFRecordShards(
+    filepaths, save_dir, prefix, max_files_per_part, 
+    label_idx):
+    """
+    converts numpy files into sharded TFRecords once, so that many small files are not opened every epoch
+    only deterministic data is written, random augmentations and mixing are applied after reading by prepareTFRecordDataset
+    the process is as follows:
+        - for each path in filepaths:
+            - load the melspectogram as float32
+            - create a class index from the filename
+            - write raw bytes, shape and class index as a tf.train.Example
+        - every max_files_per_part files go into a separate shard
+          written under a temporary name and renamed when it is complete
+    if all shards of the same list of files already exist, nothing is written
+
+    parameters
+    ----------
+
+        filepaths : list or ndarray
+            full paths to numpy files
+
+        save_dir : string
+            full path to directory where to save TFRecord shards
+
+        prefix : string
+            name of the split, used as a prefix of shard filenames
+
+        max_files_per_part : integer
+            maximum number of files in one shard
+            taken from globalVariables.py
+
+        label_idx : int
+            which idx to use when splitting filename path by underscore to create class index
+
+    returns
+    -------
+
+        shard_paths : list
+            full paths to TFRecord shards
+    """
+
+    # shards of melspectograms get their own names, so shards of preprocessed images written before are not read
+    shard_paths = getShardPaths(filepaths, save_dir, prefix + '_melspec', max_files_per_part, '.tfrecord')
+
+    if all(os.path.exists(shard_path) for shard_path in shard_paths):
+        return shard_paths
+
+    os.makedirs(save_dir, exist_ok=True)
+
+    for shard, shard_path in enumerate(shard_paths):
+
+        # an interrupted write leaves only the temporary file, so a truncated shard is never reused
+        shard_path_tmp = shard_path + '.tmp'
+
+        with tf.io.TFRecordWriter(shard_path_tmp) as writer:
+
+            for path in filepaths[shard * max_files_per_part : (shard + 1) * max_files_per_part]:
+
+                data = np.asarray(loadNumpy(path), dtype=np.float32)
+                label = createSparseValue(path, label_idx)
+
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'data': tf.train.Feature(bytes_list=tf.train.BytesList(value=[data.tobytes()])),
+                    'shape': tf.train.Feature(int64_list=tf.train.Int64List(value=list(data.shape))),
+                    'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label]))}))
+
+                writer.write(example.SerializeToString())
+
+        os.replace(shard_path_tmp, shard_path)
+
+    return shard_paths
+
+
+def prepareTFRecordDataset(
+    batch_size, num_classes, 
+    shard_paths, 
+    create_onehot, create_sparse, 
+    permutations, do_permutations, normalization, uint8_pipeline, 
+    cache_dir, shuffle_buffer_size, device_prefetch_buffer, 
+    strategy, is_val):
+    """
+    prepares a streaming tf.data pipeline from TFRecord shards written by writeTFRecordShards
+    the process is as follows:
+        - shuffle shard paths (reshuffled every epoch) and interleave them into tf.data.TFRecordDataset readers running in parallel
+        - parse records into float32 melspectograms and create one-hot or sparse labels from class indices
+        - optionally cache parsed records, so that shards are read and parsed only in the first epoch
+        - shuffle records in a buffer of shuffle_buffer_size records (reshuffled every epoch)
+        - apply random augmentations and mixing of loadBIRDCLEFSample with augmentBIRDCLEFDataset,
+          data is uint8 afterwards if uint8_pipeline = True, float32 in [0, 255] otherwise
+        - optionally apply albumentations permutations per image in a separate parallel map (permuteDataset)
+        - batch Dataset object
+        - map batches to the preprocessBatch function to apply batched permutations and normalize them
+          (if uint8_pipeline = True this is done inside the training step on GPU)
+        - prefetch batches so that loading overlaps with training
+        - distribute it across GPUs with distributeDataset, copying batches to GPUs ahead of the training step
+
+    parameters
+    ----------
+
+        batch_size : integer
+            number of training examples in one batch of data
+
+        num_classes : integer
+            number of classes
+
+        shard_paths : list
+            full paths to TFRecord shards
+
+        create_onehot : boolean
+            whether to create one-hot labels from class indices
+
+        create_sparse : boolean
+            whether to keep sparse class indices as labels
+            records only hold class indices, so one of create_onehot and create_sparse has to be True
+
+        permutations : list or tf.keras.layers.Layer
+            albumentations permutations (a list or a single transform) applied per image
+            or a batched permutation layer applied to whole batches
+
+        do_permutations : boolen
+            either to perfrom data permutations or not
+
+        normalization : function
+            normalization function to apply to data
+
+        uint8_pipeline : boolean
+            whether to keep data as uint8 and leave batched permutations and normalization to the training step
+
+        cache_dir : string
+            directory where to cache parsed records, '' to cache them in memory, None not to cache
+
+        shuffle_buffer_size : integer
+            number of records held in the shuffle buffer of training data
+            the number of records shuffles the whole dataset every epoch, which a cache otherwise replays in one order
+
+        device_prefetch_buffer : integer
+            number of batches every GPU keeps prefetched in its own memory
+
+        strategy : tf.distribute object
+            TensorFlow API used in distributed training
+
+        is_val : boolean
+            shows whether it is a validation or training iteration
+
+    returns
+    -------
+
+        data_dataset_dist : strategy.experimental_distribute_dataset object
+            streaming, preprocessed, and batched data
+    """
+
+    if not (create_onehot or create_sparse):
+        raise ValueError('TFRecord shards only hold class indices, set either create_onehot or create_sparse')
+
+    features_description = {
+        'data': tf.io.FixedLenFeature([], tf.string),
+        'shape': tf.io.FixedLenFeature([2], tf.int64),
+        'label': tf.io.FixedLenFeature([], tf.int64)}
+
+    def parseRecord(record):
+
+        example = tf.io.parse_single_example(record, features_description)
+
+        data = tf.io.decode_raw(example['data'], tf.float32)
+        data = tf.reshape(data, example['shape'])
+
+        # the loss gets labels in the same format as from the streaming pipeline
+        if create_sparse:
+            label = example['label']
+        else:
+            label = tf.one_hot(example['label'], num_classes, dtype=tf.float32)
+
+        return data, label
+
+    # shard order is shuffled every epoch on top of record shuffling,
+    # so that consecutive batches don't come from the same few shards
+    data_dataset = tf.data.Dataset.from_tensor_slices(shard_paths)
+
+    if not is_val:
+        data_dataset = data_dataset.shuffle(len(shard_paths), reshuffle_each_iteration=True)
+
+    data_dataset = data_dataset.interleave(
+        tf.data.TFRecordDataset, 
+        cycle_length=tf.data.AUTOTUNE, num_parallel_calls=tf.data.AUTOTUNE, deterministic=is_val)
+
+    data_dataset = data_dataset.map(parseRecord, num_parallel_calls=tf.data.AUTOTUNE)
+
+    # parsed records are the same every epoch, augmentations, permutations and normalization are applied after the cache
+    if cache_dir is not None:
+        if cache_dir != '':
+            os.makedirs(cache_dir, exist_ok=True)
+            shard_paths_hash = hashlib.md5('\n'.join(str(path) for path in shard_paths).encode('utf-8')).hexdigest()[:8]
+            cache_dir = os.path.join(cache_dir, 'tfrecord_' + shard_paths_hash)
+        data_dataset = data_dataset.cache(cache_dir)
+
+    # records are reshuffled every epoch after the cache, which replays them in the order of the first epoch
+    if not is_val:
+        data_dataset = data_dataset.shuffle(shuffle_buffer_size, reshuffle_each_iteration=True)
+
+    # augmentations are drawn anew every epoch after the cache, the same way as in the streaming pipeline
+    data_dataset = augmentBIRDCLEFDataset(data_dataset, batch_size, create_sparse, uint8_pipeline)
+
+    if (not is_val) and do_permutations and not isinstance(permutations, tf.keras.layers.Layer):
+        data_dataset = permuteDataset(data_dataset, permutations)
+
+    # a partial last training batch would change the shapes of the compiled training step
+    data_dataset = data_dataset.batch(batch_size, drop_remainder=(not is_val))
+
+    if not uint8_pipeline:
+        data_dataset = data_dataset.map(
+            lambda data, labels: (preprocessBatch(data, permutations, do_permutations, normalization, is_val), labels),
+            num_parallel_calls=tf.data.AUTOTUNE)
+
+    data_dataset = data_dataset.prefetch(tf.data.AUTOTUNE)
+
+    # auto-sharding only applies to multi-worker strategies, a single worker reads all shards
+    # workers then read whole shards when there are at least as many shards as replicas (so at least one per worker),
+    # otherwise every worker reads all shards and skips records of the others
+    options = tf.data.Options()
+    if len(shard_paths) >= strategy.num_replicas_in_sync:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.FILE
+    else:
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+    data_dataset = data_dataset.with_options(options)
+
+    data_dataset_dist = distributeDataset(data_dataset, strategy, device_prefetch_buffer)
+
+    return data_dataset_dist
+
+
+def writeMemmapShards(
+    filepaths, save_dir, prefix, max_files_per_part, 
+    label_idx):
+    """
+    converts numpy files into a few large float32 memory-mapped shards once
+    after the first epoch shards stay in the page cache, so later epochs read memory instead of disk
+    only deterministic data is written, random augmentations and mixing are applied after reading by prepareMemmapDataset
+    the process is as follows:
+        - for each path in filepaths:
+            - load the melspectogram as float32
+            - write it as a row of a memory-mapped .npy shard of shape (files in shard, ) + INPUT_SHAPE
+        - every max_files_per_part files go into a separate shard, class indices of a shard are saved next to it
+    if all shards of the same list of files already exist, nothing is written
+
+    parameters
+    ----------
+
+        filepaths : list or ndarray
+            full paths to numpy files
+
+        save_dir : string
+            full path to directory where to save memmap shards
+
+        prefix : string
+            name of the split, used as a prefix of shard filenames
+
+        max_files_per_part : integer
+            maximum number of files in one shard
+            taken from globalVariables.py
+
+        label_idx : int
+            which idx to use when splitting filename path by underscore to create class index
+
+    returns
+    -------
+
+        shard_paths : list
+            full paths to memmap shards, class indices are saved under the same name ending with _labels.npy
+    """
+
+    # shards of melspectograms get their own names, so shards of preprocessed images written before are not read
+    shard_paths = getShardPaths(filepaths, save_dir, prefix + '_melspec', max_files_per_part, '.npy')
+
+    if all(os.path.exists(shard_path.replace('.npy', '_labels.npy')) for shard_path in shard_paths):
+        return shard_paths
+
+    os.makedirs(save_dir, exist_ok=True)
+
+    # all melspectograms share their shape
+    _, _, numpy_shape = getNumpyHeader(filepaths[0])
+
+    for shard, shard_path in enumerate(shard_paths):
+
+        shard_filepaths = filepaths[shard * max_files_per_part : (shard + 1) * max_files_per_part]
+
+        shard_data = np.lib.format.open_memmap(
+            shard_path, mode='w+', dtype=np.float32, shape=((len(shard_filepaths), ) + tuple(numpy_shape)))
+        shard_labels = np.empty(len(shard_filepaths), dtype=np.int64)
+
+        for row, path in enumerate(shard_filepaths):
+
+            shard_data[row] = loadNumpy(path)
+
+            shard_labels[row] = createSparseValue(path, label_idx)
+
+        shard_data.flush()
+        del shard_data
+
+        # labels are written last, so a shard without them is known to be incomplete
+        np.save(shard_path.replace('.npy', '_labels.npy'), shard_labels)
+
+    return shard_paths
+
+
+def prepareMemmapDataset(
+    batch_size, num_classes, 
+    shard_paths, 
+    create_onehot, create_sparse, 
+    permutations, do_permutations, normalization, uint8_pipeline, 
+    cache_dir, shuffle_buffer_size, device_prefetch_buffer, 
+    strategy, is_val):
+    """
+    prepares a streaming tf.data pipeline from memmap shards written by writeMemmapShards
+    the process is as follows:
+        - open every shard as a read-only memory map and advise the kernel how it is going to be read
+        - shuffle (shard, row) indices of all samples (reshuffled every epoch)
+        - slice float32 melspectograms from memory maps in parallel
+        - create one-hot or sparse labels from class indices
+        - apply random augmentations and mixing of loadBIRDCLEFSample with augmentBIRDCLEFDataset,
+          data is uint8 afterwards if uint8_pipeline = True, float32 in [0, 255] otherwise
+        - optionally apply albumentations permutations per image in a separate parallel map (permuteDataset)
+        - batch Dataset object
+        - map batches to the preprocessBatch function to apply batched permutations and normalize them
+          (if uint8_pipeline = True this is done inside the training step on GPU)
+        - prefetch batches so that loading overlaps with training
+        - distribute it across GPUs with distributeDataset, copying batches to GPUs ahead of the training step
+
+    parameters
+    ----------
+
+        batch_size : integer
+            number of training examples in one batch of data
+
+        num_classes : integer
+            number of classes
+
+        shard_paths : list
+            full paths to memmap shards
+
+        create_onehot : boolean
+            whether to create one-hot labels from class indices
+
+        create_sparse : boolean
+            whether to keep sparse class indices as labels
+            shards only hold class indices, so one of create_onehot and create_sparse has to be True
+
+        permutations : list or tf.keras.layers.Layer
+            albumentations permutations (a list or a single transform) applied per image
+            or a batched permutation layer applied to whole batches
+
+        do_permutations : boolen
+            either to perfrom data permutations or not
+
+        normalization : function
+            normalization function to apply to data
+
+        uint8_pipeline : boolean
+            whether to keep data as uint8 and leave batched permutations and normalization to the training step
+
+        cache_dir : string
+            not used, memmap shards are already served from the page cache after the first epoch
+            kept so that the signature matches prepareTFRecordDataset
+
+        shuffle_buffer_size : integer
+            not used, (shard, row) indices of all samples are shuffled every epoch
+            kept so that the signature matches prepareTFRecordDataset
+
+        device_prefetch_buffer : integer
+            number of batches every GPU keeps prefetched in its own memory
+
+        strategy : tf.distribute object
+            TensorFlow API used in distributed training
+
+        is_val : boolean
+            shows whether it is a validation or training iteration
+
+    returns
+    -------
+
+        data_dataset_dist : strategy.experimental_distribute_dataset object
+            streaming, preprocessed, and batched data
+    """
+
+    if not (create_onehot or create_sparse):
+        raise ValueError('memmap shards only hold class indices, set either create_onehot or create_sparse')
+
+    shards_data = []
+    shards_labels = []
+
+    for shard_path in shard_paths:
+
+        shard_data = np.load(shard_path, mmap_mode='r')
+
+        # validation reads rows in order, training reads the whole shard in random order every epoch
+        advice = getattr(mmap, 'MADV_SEQUENTIAL' if is_val else 'MADV_WILLNEED', None)
+        if advice is not None:
+            shard_data._mmap.madvise(advice)
+
+        shards_data.append(shard_data)
+        shards_labels.append(np.load(shard_path.replace('.npy', '_labels.npy')))
+
+    shard_idxs = np.concatenate([np.full(len(labels), shard) for shard, labels in enumerate(shards_labels)])
+    row_idxs = np.concatenate([np.arange(len(labels)) for labels in shards_labels])
+    labels = np.concatenate(shards_labels)
+
+    def loadRow(shard, row):
+        return np.array(shards_data[shard][row])
+
+    def loadRowTensor(shard, row, label):
+
+        data = tf.numpy_function(loadRow, [shard, row], tf.float32)
+        data.set_shape(shards_data[0].shape[1:])
+
+        # the loss gets labels in the same format as from the streaming pipeline
+        if not create_sparse:
+            label = tf.one_hot(label, num_classes, dtype=tf.float32)
+
+        return data, label
+
+    data_dataset = tf.data.Dataset.from_tensor_slices((shard_idxs, row_idxs, labels))
+
+    if not is_val:
+        data_dataset = data_dataset.shuffle(len(labels), reshuffle_each_iteration=True)
+
+    data_dataset = data_dataset.map(loadRowTensor, num_parallel_calls=tf.data.AUTOTUNE, deterministic=is_val)
+
+    # augmentations are drawn anew every epoch, the same way as in the streaming pipeline
+    data_dataset = augmentBIRDCLEFDataset(data_dataset, batch_size, create_sparse, uint8_pipeline)
+
+    if (not is_val) and do_permutations and not isinstance(permutations, tf.keras.layers.Layer):
+        data_dataset = permuteDataset(data_dataset, permutations)
+
+    # a partial last training batch would change the shapes of the compiled training step
+    data_dataset = data_dataset.batch(batch_size, drop_remainder=(not is_val))
+
+    if not uint8_pipeline:
+        data_dataset = data_dataset.map(
+            lambda data, labels: (preprocessBatch(data, permutations, do_permutations, normalization, is_val), labels),
+            num_parallel_calls=tf.data.AUTOTUNE)
+
+    data_dataset = data_dataset.prefetch(tf.data.AUTOTUNE)
+
+    data_dataset_dist = distributeDataset(data_dataset, strategy, device_prefetch_buffer)
+
+    return data_dataset_dist
+
+
 def prepareDetectionDataset(filepaths, bbox_format, meta, num_classes, label_id_offset, permutations, normalization, is_val):
     """
     prepares data for training for object detection tasks
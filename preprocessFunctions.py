@@ -41,22 +41,30 @@ def minMaxNormalizeNumpy(x):
 def minMaxNormalizeTensor(x):
     """
     normalizes tensor image to [0, 1] interval
+    works both on a single image and on a batch of images (each image is normalized separately)
 
     parameters
     ----------
         x : tensor
-            input image
+            input image of shape (height, width, channels) or batch of shape (batch, height, width, channels)
 
     returns
     -------
-        x : ndarray
-            normalized tensor image
+        x : tensor
+            normalized tensor image, float32 unless x is a float16 or bfloat16 tensor
     """
 
-    x = tf.subtract(x, tf.reduce_min(x))
-    x = tf.divide(x, tf.reduce_max(x))
+    # minimum and maximum are computed in float32, half precision inputs are cast back afterwards
+    dtype = x.dtype if x.dtype.is_floating else tf.float32
+    x = tf.cast(x, tf.float32)
+
+    x_min = tf.reduce_min(x, axis=[-3, -2, -1], keepdims=True)
+    x_max = tf.reduce_max(x, axis=[-3, -2, -1], keepdims=True)
+
+    # epsilon keeps constant images (e.g. silent melspectograms) at zero instead of NaN
+    x = tf.divide(tf.subtract(x, x_min), tf.subtract(x_max, x_min) + K.epsilon())
 
-    return x
+    return tf.cast(x, dtype)
 
 
 def meanStdNormalize(x):
@@ -1,16 +1,92 @@
-from prepareTrainDataset import prepareClassificationDataset, prepareBIRDCLEFDataset, prepareDetectionDataset
+from prepareTrainDataset import preprocessBatch, prepareDetectionDataset
 from callbacks import reduceLRCustom,reduceLROnPlateau, LRLadderDecrease, saveTrainInfo, saveModel, saveTrainInfoDetection, saveCheckpointDetection
-from helpers import getFullPaths, loadNumpy, getFeaturesFromPath, getLabelFromPath
+from helpers import getFullPaths, loadNumpy, getFeaturesFromPath, getLabelFromPath, getGPUMemoryTotal
 
 import time
 import tensorflow as tf
 from sklearn.utils import shuffle
 
 
-def classificationDistributedTrainStepWrapper():
+def probeBatchSize(model, input_shape, batch_size_min, batch_size_mult, memory_fraction, device):
+    """
+    finds the largest batch per GPU that fits into memory
+    peak memory of a forward and backward pass is measured at two batch sizes and extrapolated linearly,
+    memory of optimizer slots (two per variable, as in Adam) is added since they don't exist yet
+
+    parameters
+    ----------
+
+        model : object
+            built model with a single input
+
+        input_shape : tuple
+            shape of one input sample
+
+        batch_size_min : integer
+            smallest batch size, also the returned value if memory can't be measured
+
+        batch_size_mult : integer
+            returned batch size is batch_size_min plus a multiple of it
+
+        memory_fraction : decimal
+            fraction of GPU memory that training may use
+
+        device : string
+            GPU to measure memory on
+
+    returns
+    -------
+
+        batch_size : integer
+            batch size per GPU
+    """
+
+    memory_total = getGPUMemoryTotal()
+
+    if (memory_total is None) or (len(model.inputs) > 1):
+        return batch_size_min
+
+    peaks = []
+
+    for batch_size in (batch_size_min, batch_size_min + batch_size_mult):
+
+        tf.config.experimental.reset_memory_stats(device)
+
+        with tf.device(device):
+
+            data = tf.zeros((batch_size, ) + tuple(input_shape), dtype=tf.float32)
+
+            with tf.GradientTape() as tape:
+                predictions = model(data, training=True)
+                loss = tf.reduce_mean(tf.cast(predictions, tf.float32))
+
+            gradients = tape.gradient(loss, model.trainable_variables)
+
+        peaks.append(tf.config.experimental.get_memory_info(device)['peak'])
+
+        del data, predictions, loss, gradients
+
+    memory_per_sample = max(1, (peaks[1] - peaks[0]) / batch_size_mult)
+    memory_slots = 2 * sum(variable.shape.num_elements() * variable.dtype.size for variable in model.trainable_variables)
+    memory_fixed = peaks[0] - memory_per_sample * batch_size_min + memory_slots
+
+    num_mults = int((memory_fraction * memory_total - memory_fixed - memory_per_sample * batch_size_min) // (memory_per_sample * batch_size_mult))
+    batch_size = batch_size_min + max(0, num_mults) * batch_size_mult
+
+    return batch_size
+
+
+def classificationDistributedTrainStepWrapper(jit_compile=False):
     """
     wrapper for distributed training iteration on a batch of data
 
+    parameters
+    ----------
+
+        jit_compile : boolean
+            whether to compile the forward and backward pass of every replica with XLA
+            gradient all-reduce and the optimizer update stay outside of the compiled function
+
     returns
     -------
 
@@ -18,8 +94,13 @@ def classificationDistributedTrainStepWrapper():
             function that computes reduced loss on a batch of data
     """
 
+    if jit_compile:
+        forwardBackward = tf.function(classificationForwardBackward, jit_compile=True)
+    else:
+        forwardBackward = classificationForwardBackward
+
     @tf.function
-    def classificationDistributedTrainStep(inputs, model, compute_total_loss, optimizer, metric_type, train_metrics, strategy):
+    def classificationDistributedTrainStep(inputs, model, train_model, compute_total_loss, optimizer, metric_type, train_metrics, preprocessing, accumulated_gradients, apply_gradients, strategy):
         """
         computes losses on every GPU and reduces (averages) them
 
@@ -32,6 +113,9 @@ def classificationDistributedTrainStepWrapper():
             model : object
                 model that is being trained
 
+            train_model : object
+                model used for the training forward pass, either model or its part sharing the weights
+
             compute_total_loss : function
                 returns average loss for each loss calculated on each GPU
 
@@ -44,6 +128,18 @@ def classificationDistributedTrainStepWrapper():
             train_metrics : list
                 list of train metrics to calculate
 
+            preprocessing : function
+                batched permutations and normalization applied on every GPU before the forward pass
+                None if data is already preprocessed in the tf.data pipeline
+
+            accumulated_gradients : list
+                per-GPU variables that gradients of micro-batches are summed into
+                None if every batch updates the model
+
+            apply_gradients : boolean
+                whether to update the model with accumulated gradients after this micro-batch
+                python boolean, so the step is traced at most twice
+
             strategy : tf.distribute object
                 TensorFlow API used in distributed training
 
@@ -56,7 +152,8 @@ def classificationDistributedTrainStepWrapper():
         """
 
         per_replica_losses, per_replica_metrics = strategy.run(classificationTrainStep, args=(
-            inputs, model, compute_total_loss, optimizer, metric_type, train_metrics))
+            inputs, model, train_model, compute_total_loss, optimizer, metric_type, train_metrics, preprocessing, forwardBackward, 
+            accumulated_gradients, apply_gradients))
 
         reduced_loss = strategy.reduce(
             tf.distribute.ReduceOp.SUM, per_replica_losses, axis=None)
@@ -80,9 +177,75 @@ def classificationDistributedTrainStepWrapper():
     return classificationDistributedTrainStep
 
 
-def classificationTrainStep(inputs, model, compute_total_loss, optimizer, metric_type, train_metrics):
+def classificationForwardBackward(prediction_data, labels, model, train_model, compute_total_loss, optimizer):
+    """
+    computes predictions, loss and gradients on a batch of data without updating the model
+    kept separate from the optimizer update so that it can be compiled with XLA
+
+    parameters
+    ----------
+
+        prediction_data : tensor or list
+            input data and optionally additional features
+
+        labels : tensor or list
+            target labels
+
+        model : object
+            model that is being trained, gradients are computed for its trainable variables
+
+        train_model : object
+            model used for the forward pass, either model or its part sharing the weights
+
+        compute_total_loss : function
+            returns average loss for each loss calculated on each GPU
+
+        optimizer : object
+            function or an algorithm that modifies weights and learning rate of a model
+            only used for loss scaling
+
+    returns
+    -------
+
+        loss : tensor
+            total loss of a batch of data
+
+        gradients : list
+            gradients of the loss with respect to trainable variables
+
+        predictions : tensor or list
+            outputs of train_model
+    """
+
+    with tf.GradientTape() as tape:
+
+        predictions = train_model(prediction_data, training=True)
+
+        labels_concat = tf.concat(labels, axis=1)
+        predictions_concat = tf.concat(predictions, axis=1)
+
+        loss = compute_total_loss(labels_concat, predictions_concat)
+
+        # float16 gradients underflow without loss scaling, bfloat16 doesn't need it
+        if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            scaled_loss = optimizer.get_scaled_loss(loss)
+        else:
+            scaled_loss = loss
+
+    gradients = tape.gradient(scaled_loss, model.trainable_variables)
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        gradients = optimizer.get_unscaled_gradients(gradients)
+
+    return loss, gradients, predictions
+
+
+def classificationTrainStep(
+        inputs, model, train_model, compute_total_loss, optimizer, metric_type, train_metrics, preprocessing, forwardBackward, 
+        accumulated_gradients, apply_gradients):
     """
     computes loss on a batch of data, performs gradient descent to train a model and updates training metrics
+    if accumulated_gradients are given, gradients of the batch are added to them
+    and the model is only updated (and accumulators zeroed) when apply_gradients is True
 
     parameters
     ----------
@@ -93,6 +256,11 @@ def classificationTrainStep(inputs, model, compute_total_loss, optimizer, metric
         model : object
             model that is being trained
 
+        train_model : object
+            model used for the training forward pass, either model or its part sharing the weights
+            if it is not model, it stops at the inputs of the prediction layer of model,
+            which is applied to its outputs outside of the gradient tape to update training metrics
+
         compute_total_loss : function
             returns average loss for each loss calculated on each GPU
 
@@ -105,6 +273,20 @@ def classificationTrainStep(inputs, model, compute_total_loss, optimizer, metric
         train_metrics : list
             list of train metrics to calculate
 
+        preprocessing : function
+            batched permutations and normalization applied before the forward pass
+            None if data is already preprocessed in the tf.data pipeline
+
+        forwardBackward : function
+            classificationForwardBackward, optionally compiled with XLA
+
+        accumulated_gradients : list
+            per-GPU variables that gradients of micro-batches are summed into
+            None if every batch updates the model
+
+        apply_gradients : boolean
+            whether to update the model with accumulated gradients after this micro-batch
+
     returns
     -------
 
@@ -132,30 +314,49 @@ def classificationTrainStep(inputs, model, compute_total_loss, optimizer, metric
 
         labels = inputs[1]
 
-    with tf.GradientTape() as tape:
+    if preprocessing is not None:
+        data = preprocessing(data)
 
-        if len(features) == 0:
+    if len(features) == 0:
 
-            prediction_data = data
-        
-        else:
+        prediction_data = data
+    
+    else:
 
-            prediction_data = []
-            prediction_data.append(data)
+        prediction_data = []
+        prediction_data.append(data)
 
-            for feature in features:
+        for feature in features:
 
-                prediction_data.append(feature)
+            prediction_data.append(feature)
 
-        predictions = model(prediction_data, training=True)
+    loss, gradients, predictions = forwardBackward(prediction_data, labels, model, train_model, compute_total_loss, optimizer)
 
-        labels_concat = tf.concat(labels, axis=1)
-        predictions_concat = tf.concat(predictions, axis=1)
+    if accumulated_gradients is None:
 
-        loss = compute_total_loss(labels_concat, predictions_concat)
+        optimizer.apply_gradients(zip(gradients, model.trainable_variables))
 
-    gradients = tape.gradient(loss, model.trainable_variables)
-    optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+    else:
+
+        for accumulated_gradient, gradient in zip(accumulated_gradients, gradients):
+            if gradient is not None:
+                accumulated_gradient.assign_add(gradient)
+
+        if apply_gradients:
+
+            optimizer.apply_gradients(zip(
+                [accumulated_gradient.read_value() for accumulated_gradient in accumulated_gradients], 
+                model.trainable_variables))
+
+            for accumulated_gradient in accumulated_gradients:
+                accumulated_gradient.assign(tf.zeros_like(accumulated_gradient))
+
+    if train_model is not model:
+
+        predictions = model.layers[-1](predictions)
+
+    labels_concat = tf.concat(labels, axis=1)
+    predictions_concat = tf.concat(predictions, axis=1)
 
     if metric_type == 'custom':
 
@@ -172,10 +373,16 @@ def classificationTrainStep(inputs, model, compute_total_loss, optimizer, metric
         return loss, 0.0
 
 
-def classificationDistributedValStepWrapper():
+def classificationDistributedValStepWrapper(jit_compile=False):
     """
     wrapper for distributed validation iteration on a batch of data
 
+    parameters
+    ----------
+
+        jit_compile : boolean
+            whether to compile the forward pass of every replica with XLA
+
     returns
     -------
 
@@ -183,8 +390,13 @@ def classificationDistributedValStepWrapper():
             function that calls another function to compute validation loss on a batch of data
     """
 
+    if jit_compile:
+        forward = tf.function(classificationForward, jit_compile=True)
+    else:
+        forward = classificationForward
+
     @tf.function
-    def classificationDistributedValStep(inputs, model, loss_object, val_loss, metric_type, val_metrics, strategy):
+    def classificationDistributedValStep(inputs, model, loss_object, val_loss, metric_type, val_metrics, preprocessing, strategy):
         """
         calls classificationValStep function to compute validation loss on a batch of data and update validation metrics
         no need to reduce the loss because it is being updated inside classificationValStep function
@@ -211,6 +423,10 @@ def classificationDistributedValStepWrapper():
             val_metrics : list
                 list of validation metric to calculate
 
+            preprocessing : function
+                normalization applied on every GPU before the forward pass
+                None if data is already preprocessed in the tf.data pipeline
+
             strategy : tf.distribute object
                 TensorFlow API used in distributed training
 
@@ -221,7 +437,7 @@ def classificationDistributedValStepWrapper():
                 calls a function that computes and updates states of validation loss and metrics
         """
 
-        per_replica_metrics = strategy.run(classificationValStep, args=(inputs, model, loss_object, val_loss, metric_type, val_metrics))
+        per_replica_metrics = strategy.run(classificationValStep, args=(inputs, model, loss_object, val_loss, metric_type, val_metrics, preprocessing, forward))
 
         reduced_metric = 0.0
         if metric_type == 'custom':
@@ -234,7 +450,31 @@ def classificationDistributedValStepWrapper():
     return classificationDistributedValStep
 
 
-def classificationValStep(inputs, model, loss_object, val_loss, metric_type, val_metrics):
+def classificationForward(prediction_data, model):
+    """
+    computes predictions of a model in inference mode
+    kept as a separate function so that it can be compiled with XLA
+
+    parameters
+    ----------
+
+        prediction_data : tensor or list
+            input data and optionally additional features
+
+        model : object
+            model that is being validated
+
+    returns
+    -------
+
+        predictions : tensor or list
+            predictions of the model
+    """
+
+    return model(prediction_data, training=False)
+
+
+def classificationValStep(inputs, model, loss_object, val_loss, metric_type, val_metrics, preprocessing, forward):
     """
     computes loss on a batch of data and updates states of validation loss and metrics
 
@@ -259,6 +499,13 @@ def classificationValStep(inputs, model, loss_object, val_loss, metric_type, val
         
         val_metrics : list
             list of validation metrics to calculate
+
+        preprocessing : function
+            normalization applied before the forward pass
+            None if data is already preprocessed in the tf.data pipeline
+
+        forward : function
+            classificationForward, optionally compiled with XLA
     """
 
     if type(inputs[0]) is tuple:
@@ -281,6 +528,9 @@ def classificationValStep(inputs, model, loss_object, val_loss, metric_type, val
 
         labels = inputs[1]
 
+    if preprocessing is not None:
+        data = preprocessing(data)
+
     if len(features) == 0:
 
         prediction_data = data
@@ -294,7 +544,7 @@ def classificationValStep(inputs, model, loss_object, val_loss, metric_type, val
 
             prediction_data.append(feature)
 
-    predictions = model(prediction_data, training=False)
+    predictions = forward(prediction_data, model)
     
     labels_concat = tf.concat(labels, axis=1)
     predictions_concat = tf.concat(predictions, axis=1)
@@ -318,14 +568,105 @@ def classificationValStep(inputs, model, loss_object, val_loss, metric_type, val
         return 0.0
 
 
+def classificationCustomStepsWrapper(
+        head_model, 
+        permutations, do_permutations, normalization, uint8_pipeline, jit_compile,
+        grad_accum_steps,
+        strategy):
+    """
+    builds distributed training and validation steps and the objects they are called with once per model,
+    so that every fold of a model reuses the same traced (and XLA-compiled) steps
+
+    parameters
+    ----------
+
+        head_model : object
+            model whose trainable variables gradients are accumulated for
+
+        permutations : list or tf.keras.layers.Layer
+            albumentations permutations (a list or a single transform) applied per image
+            or a batched permutation layer applied to whole batches
+
+        do_permutations : boolean
+            either to perfrom data permutations or not
+
+        normalization : function
+            normalization function to apply to data
+
+        uint8_pipeline : boolean
+            if True, datasets yield uint8 data and batched permutations and normalization are applied
+            inside the training/validation steps on every GPU instead of the tf.data pipeline
+
+        jit_compile : boolean
+            whether to compile forward and backward passes with XLA
+
+        grad_accum_steps : integer
+            number of micro-batches to accumulate gradients over before every optimizer update
+
+        strategy : tf.distribute object
+            TensorFlow API used in distributed training
+
+    returns
+    -------
+
+        wrapperTrain : function
+            distributed training step
+
+        wrapperVal : function
+            distributed validation step
+
+        trainPreprocessing : function
+            preprocessing applied inside the training step, None if uint8_pipeline = False
+
+        valPreprocessing : function
+            preprocessing applied inside the validation step, None if uint8_pipeline = False
+
+        accumulated_gradients : list
+            per-GPU gradient accumulators, None if grad_accum_steps = 1
+    """
+
+    wrapperTrain = classificationDistributedTrainStepWrapper(jit_compile)
+    wrapperVal = classificationDistributedValStepWrapper(jit_compile)
+
+    # preprocessing functions and accumulators are arguments of the traced steps,
+    # new objects in every fold would retrace them, so they are created once here as well
+    if uint8_pipeline:
+
+        def trainPreprocessing(data):
+            return preprocessBatch(data, permutations, do_permutations, normalization, is_val=False)
+
+        def valPreprocessing(data):
+            return preprocessBatch(data, None, do_permutations, normalization, is_val=True)
+
+    else:
+
+        trainPreprocessing = None
+        valPreprocessing = None
+
+    if grad_accum_steps > 1:
+
+        # ON_READ variables keep a separate copy on every GPU, gradients are all-reduced only by apply_gradients
+        with strategy.scope():
+            accumulated_gradients = [
+                tf.Variable(
+                    tf.zeros(variable.shape, dtype=variable.dtype), trainable=False, 
+                    synchronization=tf.VariableSynchronization.ON_READ, aggregation=tf.VariableAggregation.SUM) 
+                for variable in head_model.trainable_variables]
+
+    else:
+
+        accumulated_gradients = None
+
+    return wrapperTrain, wrapperVal, trainPreprocessing, valPreprocessing, accumulated_gradients
+
+
 def classificationCustomTrain(
-        num_epochs, start_epoch, batch_size, num_classes, num_add_classes,  
-        train_paths_list, val_paths_list, do_validation, max_fileparts_train, max_fileparts_val, fold,
-        metadata, id_column, feature_columns, add_features_columns, 
-        filename_underscore, create_onehot, create_sparse, label_idx, label_idxs_add,   
-        permutations, do_permutations, normalization,
-        model_name, model,
+        num_epochs, start_epoch, 
+        train_dataset, val_dataset, do_validation, fold,
+        wrapperTrain, wrapperVal, trainPreprocessing, valPreprocessing, accumulated_gradients,
+        model_name, model, head_model, train_model,
         loss_object, val_loss, compute_total_loss,
+        grad_accum_steps,
         custom_lrs_epochs,
         lr_ladder, lr_ladder_step, lr_ladder_epochs, 
         reduce_lr_plateau, reduce_lr_patience, reduce_lr_factor, reduce_lr_minimal_lr, reduce_lr_metric,
@@ -335,8 +676,7 @@ def classificationCustomTrain(
         strategy):
     """
     main training function for classification/encoding-decoding tasks
-    for each epoch it divides training and validation files into parts
-    for every part it preprocessed data, computes loss and metrics
+    for each epoch it iterates through streaming training and validation datasets, computes loss and metrics
     after an epoch is finished, it saves the training information and model weights
     as well as updates loss and metric states of the model and learning rate
 
@@ -349,80 +689,49 @@ def classificationCustomTrain(
         start_epoch : integer
             number of the epoch from which the training process starts
 
-        batch_size : integer
-            number of training examples in one batch of data
-
-        num_classes : integer
-            number of classes
-
-        num_add_classes : list
-            contains integers representing number of classes in additional features
-
-        train_paths_list : list
-            full paths to train files
+        train_dataset : strategy.experimental_distribute_dataset object
+            streaming training data, built once by prepareStreamingDataset and iterated every epoch
 
-        val_paths_list : list
-            full paths to validation files
+        val_dataset : strategy.experimental_distribute_dataset object
+            streaming validation data, built once by prepareStreamingDataset and iterated every epoch
 
         do_validation : boolean
             do validation or not
 
-        max_fileparts_train : integer
-            maximum number of training parts
-            one part has a certain number of files in it
-            used to solve memory allocation error
-
-        max_fileparts_val : integer
-            maximum number of validation parts
-            one part has a certain number of files in it
-            used to solve memory allocation error
-
         fold : integer
             fold number
 
-        metadata : dataframe
-            table containing ids of files, additional features and features to predict
-
-        id_column : string
-            name of the id column in the metadata
+        wrapperTrain : function
+            distributed training step returned by classificationCustomStepsWrapper
 
-        feature_columns : list
-            names of target feature columns
+        wrapperVal : function
+            distributed validation step returned by classificationCustomStepsWrapper
 
-        add_features_columns : list
-            names of additional feature columns to add as an input when training
+        trainPreprocessing : function
+            batched permutations and normalization applied inside the training step
+            None if data is already preprocessed in the tf.data pipeline
 
-        filename_underscore : boolean
-            True if end of a filename has a class after an underscore
-            used to properly extract data from metadata
+        valPreprocessing : function
+            batched normalization applied inside the validation step
+            None if data is already preprocessed in the tf.data pipeline
 
-        create_onehot : boolean
-            whether to use metadata and load one-hot vector from there
-            or create a new one using a name of the file
-
-        create_sparse : boolean
-            used to create sparse label
-
-        label_idx : 
-            which idx to use when splitting filename path by underscore to create one-hot vector
-
-        label_idxs_add : list
-             contains indicies to use when splitting filename path by underscore to create one-hot vectors for additional features
-
-        permutations : list
-            list of data permutation functions
-
-        do_permutations : boolean
-            either to perfrom data permutations or not
-
-        normalization : function
-            normalization function to apply to data
+        accumulated_gradients : list
+            per-GPU variables that gradients of micro-batches are summed into
+            None if every batch updates the model
 
         model_name : string
             name of the model
 
         model : object
-            model to train
+            model to train, saved after every epoch
+
+        head_model : object
+            model that training and validation steps are run on
+            either model itself or its head layers sharing its weights, trained on pre-extracted body features
+
+        train_model : object
+            model used for the training forward pass
+            either head_model itself or a model sharing its weights that outputs inputs of the prediction layer (sampled softmax)
 
         loss_object : object/function
             computes loss between true and predicted labels
@@ -434,6 +743,9 @@ def classificationCustomTrain(
         compute_total_loss : function
             returns average loss for each loss calculated on each GPU
 
+        grad_accum_steps : integer
+            number of micro-batches to accumulate gradients over before every optimizer update
+
         custom_lrs_epochs : list
             list of epochs when to decrease learning rate
 
@@ -485,8 +797,14 @@ def classificationCustomTrain(
             TensorFlow API used in distributed training
     """
 
-    wrapperTrain = classificationDistributedTrainStepWrapper()
-    wrapperVal = classificationDistributedValStepWrapper()
+    if accumulated_gradients is not None:
+
+        # gradients of micro-batches left over at the end of the previous fold are discarded
+        def resetAccumulatedGradients():
+            for accumulated_gradient in accumulated_gradients:
+                accumulated_gradient.assign(tf.zeros_like(accumulated_gradient))
+
+        strategy.run(resetAccumulatedGradients)
 
     metrics_dict = {
         'train_loss': [],
@@ -503,125 +821,75 @@ def classificationCustomTrain(
         for metric in val_metrics:
             metrics_dict[metric.name] = []
 
-    for epoch in range(start_epoch, num_epochs):
+    # counts micro-batches across epochs, so that micro-batches left over at the end of an epoch
+    # are carried over to the next one and every update sums exactly grad_accum_steps of them
+    num_micro_batches = 0
 
-        train_paths_list_shuffled = shuffle(train_paths_list)
-        if do_validation:
-            val_paths_list_shuffled = shuffle(val_paths_list)
+    for epoch in range(start_epoch, num_epochs):
 
         total_loss = 0.0
         total_train_metric = 0.0
         num_train_batches = 0
 
-        for part in range(max_fileparts_train):
-
-            start_part_time = time.time()
-
-            train_filepaths_part = train_paths_list_shuffled[
-                int(part * len(train_paths_list_shuffled) / max_fileparts_train) :
-                int(((part + 1) / max_fileparts_train) * len(train_paths_list_shuffled))]
+        start_epoch_time = time.time()
 
-            start_load_data_time = time.time()
-            if fold == None:
-                print('\nEpoch ' + str(epoch + 1) + '. Loading training data...', flush=True)
-            else:
-                print('\nEpoch ' + str(epoch + 1) + '. Fold ' + str(fold + 1) + '. Loading training data...', flush=True)
+        for batch in train_dataset:
 
-            train_distributed_part = prepareBIRDCLEFDataset(
-                batch_size, num_classes, num_add_classes,  
-                train_paths_list_shuffled, train_filepaths_part, 
-                metadata, id_column, feature_columns, add_features_columns, 
-                filename_underscore, create_onehot, create_sparse, label_idx, label_idxs_add,   
-                permutations, do_permutations, normalization, 
-                strategy, is_val=False)
+            num_micro_batches += 1
+            apply_gradients = (accumulated_gradients is None) or (num_micro_batches % grad_accum_steps == 0)
 
-            end_load_data_time = time.time()
-            if fold == None:
-                print('\nEpoch ' + str(epoch + 1) + '. Finished loading training data. Time passed: ' 
-                    + str(end_load_data_time - start_load_data_time), flush=True)
-            else:
-                print('\nEpoch ' + str(epoch + 1) + '. Fold ' + str(fold + 1) + '. Finished loading training data. Time passed: ' 
-                    + str(end_load_data_time - start_load_data_time), flush=True)
+            batch_loss, batch_train_metric = wrapperTrain(
+                batch, head_model, train_model, compute_total_loss, optimizer, metric_type, train_metrics, trainPreprocessing, 
+                accumulated_gradients, apply_gradients, strategy)
 
-            for batch in train_distributed_part:
+            # loss of a micro-batch is averaged over the effective batch
+            total_loss += batch_loss * grad_accum_steps
+            total_train_metric += batch_train_metric
 
-                batch_loss, batch_train_metric = wrapperTrain(
-                    batch, model, compute_total_loss, optimizer, metric_type, train_metrics, strategy)
+            num_train_batches += 1
 
-                total_loss += batch_loss
-                total_train_metric += batch_train_metric
+            # the first training step of a model traces the step, compiles it with XLA and runs cuDNN autotuning,
+            # so the measured time of the first epoch starts after it
+            if (epoch == start_epoch) and (num_train_batches == 1):
+                start_epoch_time = time.time()
 
-                num_train_batches += 1
-
-            end_part_time = time.time()
-            if fold == None:
-                print('\nEpoch ' + str(epoch + 1) + '. Training: part ' + str(part + 1) + '/' + str(max_fileparts_train) +
-                    ', passed time: ' + str(end_part_time - start_part_time), flush=True)
-            else:
-                print('\nEpoch ' + str(epoch + 1) + '. Fold ' + str(fold + 1) + '. Training: part ' + str(part + 1) + '/' + str(max_fileparts_train) +
-                    ', passed time: ' + str(end_part_time - start_part_time), flush=True)
+        end_epoch_time = time.time()
+        if fold == None:
+            print('\nEpoch ' + str(epoch + 1) + '. Training: passed time: ' 
+                + str(end_epoch_time - start_epoch_time), flush=True)
+        else:
+            print('\nEpoch ' + str(epoch + 1) + '. Fold ' + str(fold + 1) + '. Training: passed time: ' 
+                + str(end_epoch_time - start_epoch_time), flush=True)
 
         train_loss = total_loss / num_train_batches
         custom_train_metric = total_train_metric / num_train_batches
 
-        del train_distributed_part
-
         total_val_metric = 0.0
         num_val_batches = 0
 
         if do_validation:
 
-            for part in range(max_fileparts_val):
-
-                start_part_time = time.time()
-
-                val_filepaths_part = val_paths_list_shuffled[
-                    int(part * len(val_paths_list_shuffled) / max_fileparts_val) :
-                    int(((part + 1) / max_fileparts_val) * len(val_paths_list_shuffled))]
-
-                start_load_data_time = time.time()
-                if fold == None:
-                    print('\nEpoch ' + str(epoch + 1) + '. Loading validation data...', flush=True)
-                else:
-                    print('\nEpoch ' + str(epoch + 1) + '. Fold ' + str(fold + 1) + '. Loading validation data...', flush=True)
-
-                val_distributed_part = prepareBIRDCLEFDataset(
-                    batch_size, num_classes, num_add_classes, 
-                    val_paths_list_shuffled, val_filepaths_part, 
-                    metadata, id_column, feature_columns, add_features_columns, 
-                    filename_underscore, create_onehot, create_sparse, label_idx, label_idxs_add, 
-                    None, do_permutations, normalization, 
-                    strategy, is_val=True)
-
-                end_load_data_time = time.time()
-                if fold == None:
-                    print('\nEpoch ' + str(epoch + 1) + '. Finished validation loading data. Time passed: ' 
-                        + str(end_load_data_time - start_load_data_time), flush=True)
-                else:
-                    print('\nEpoch ' + str(epoch + 1) + '. Fold ' + str(fold + 1) + '. Finished validation loading data. Time passed: ' 
-                        + str(end_load_data_time - start_load_data_time), flush=True)
+            start_epoch_time = time.time()
 
-                for batch in val_distributed_part:
+            for batch in val_dataset:
 
-                    batch_val_metric = wrapperVal(
-                        batch, model, loss_object, val_loss, metric_type, val_metrics, strategy)
+                batch_val_metric = wrapperVal(
+                    batch, head_model, loss_object, val_loss, metric_type, val_metrics, valPreprocessing, strategy)
 
-                    total_val_metric += batch_val_metric
+                total_val_metric += batch_val_metric
 
-                    num_val_batches += 1
+                num_val_batches += 1
 
-                end_part_time = time.time()
-                if fold == None:
-                    print('\nEpoch ' + str(epoch + 1) + '. Validation: part ' + str(part + 1) + '/' + str(max_fileparts_val) +
-                        ', passed time: ' + str(end_part_time - start_part_time), flush=True)
-                else:
-                    print('\nEpoch ' + str(epoch + 1) + '. Fold ' + str(fold + 1) + '. Validation: part ' + str(part + 1) + '/' + str(max_fileparts_val) +
-                        ', passed time: ' + str(end_part_time - start_part_time), flush=True)
+            end_epoch_time = time.time()
+            if fold == None:
+                print('\nEpoch ' + str(epoch + 1) + '. Validation: passed time: ' 
+                    + str(end_epoch_time - start_epoch_time), flush=True)
+            else:
+                print('\nEpoch ' + str(epoch + 1) + '. Fold ' + str(fold + 1) + '. Validation: passed time: ' 
+                    + str(end_epoch_time - start_epoch_time), flush=True)
 
             custom_val_metric = total_val_metric / num_val_batches
 
-            del val_distributed_part
-
             metrics_dict['train_loss'].append(train_loss)
             metrics_dict['val_loss'].append(val_loss.result().numpy())
 
@@ -695,12 +963,6 @@ def classificationCustomTrain(
                 for (train_metric, val_metric) in zip(train_metrics, val_metrics):
                     train_metric.reset_states()
                     val_metric.reset_states()
-
-            # sleep 120 seconds
-            if ((epoch + 1) % 10 == 0):
-
-                print('\nSleeping 120 seconds after every 10 epochs. Zzz...', flush=True)
-                time.sleep(120)
         
         else:
 
@@ -765,12 +1027,6 @@ def classificationCustomTrain(
                 for train_metric in train_metrics:
                     train_metric.reset_states()
 
-            # sleep 120 seconds
-            if ((epoch + 1) % 10 == 0):
-
-                print('\nSleeping 120 seconds after every 10 epochs. Zzz...', flush=True)
-                time.sleep(120)
-
 
 def detectionTrainStep(
         image_list, groundtruth_boxes_list, groundtruth_classes_list,